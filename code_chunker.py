@@ -0,0 +1,257 @@
+import ast
+import re
+
+# 設定
+MAX_CHUNK_RATIO = 1.5  # 定義がチャンクサイズのこの倍率を超えたら行単位で分割する
+SPLIT_OVERLAP_LINES = 2  # 大きな定義を行単位で分割するときに重ねる行数
+
+# 文字列リテラル（中の括弧を数えないように取り除く）
+_STRING_PATTERN = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|`(?:\\.|[^`\\])*`')
+# 定義の名前（class Foo / function foo / def foo / func foo / fn foo / const foo = など）
+_SYMBOL_PATTERNS = [
+    re.compile(r"\b(?:class|interface|struct|enum|trait|impl|module|type|function|def|func|fn)\s+(?:\([^)]*\)\s*)?([A-Za-z_$][\w$]*)"),
+    re.compile(r"\b(?:const|let|var)\s+([A-Za-z_$][\w$]*)\s*="),
+    re.compile(r"([A-Za-z_][\w:~]*)\s*\([^;]*$"),
+]
+# 直後の定義に含めるコメント・デコレータ・アノテーションの行
+_ATTACHED_PREFIXES = ("//", "/*", "*", "#", "@")
+
+class Unit:
+    """ファイル内の連続した行範囲（1始まり、終端を含む）と、その範囲が表す定義の名前"""
+
+    def __init__(self, symbol, start_line, end_line):
+        self.symbol = symbol
+        self.start_line = start_line
+        self.end_line = end_line
+
+def _split_lines(text):
+    """改行文字 (\n) だけで行に分ける（ast の行番号と一致させるため str.splitlines は使わない）"""
+    lines = [line + "\n" for line in text.split("\n")]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+def _text(lines, unit):
+    return "".join(lines[unit.start_line - 1:unit.end_line])
+
+def _python_units(lines, body, prefix, start_line, end_line, max_chars):
+    """Pythonの文の並びを、直前のコメントや空行を含めた定義単位の範囲に分ける"""
+    units = []
+    for node in body:
+        node_start = min([node.lineno] + [decorator.lineno for decorator in getattr(node, "decorator_list", [])])
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            symbol = prefix + node.name
+        elif isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            symbol = prefix + node.targets[0].id
+        else:
+            symbol = None
+        unit_start = units[-1].end_line + 1 if units else start_line
+        unit = Unit(symbol, min(unit_start, node_start), node.end_lineno)
+
+        # 大きなクラスはメソッド単位に分ける（クラスの宣言部分は最初のメソッドに含める）
+        if isinstance(node, ast.ClassDef) and len(_text(lines, unit)) > max_chars:
+            units.extend(_python_units(lines, node.body, symbol + ".", unit.start_line, unit.end_line, max_chars))
+        else:
+            units.append(unit)
+
+    if units:
+        units[-1].end_line = end_line
+    elif start_line <= end_line:
+        units.append(Unit(None, start_line, end_line))
+    return units
+
+def _strip_code_line(line, in_block_comment):
+    """括弧を数えるために文字列とコメントを取り除いた行を返す"""
+    code = []
+    position = 0
+    while position < len(line):
+        if in_block_comment:
+            end = line.find("*/", position)
+            if end == -1:
+                return "".join(code), True
+            position = end + 2
+            in_block_comment = False
+            continue
+        start = line.find("/*", position)
+        segment = line[position:] if start == -1 else line[position:start]
+        segment = _STRING_PATTERN.sub('""', segment)
+        comment = segment.find("//")
+        if comment != -1:
+            code.append(segment[:comment])
+            return "".join(code), False
+        code.append(segment)
+        if start == -1:
+            break
+        position = start + 2
+        in_block_comment = True
+    return "".join(code), in_block_comment
+
+def _symbol_name(line):
+    for pattern in _SYMBOL_PATTERNS:
+        match = pattern.search(line)
+        if match:
+            return match.group(1)
+    return None
+
+def _brace_units(lines):
+    """波括弧の深さとインデントから、トップレベルの定義の開始行で範囲を分ける"""
+    boundaries = []
+    depth = 0
+    in_block_comment = False
+    for index, line in enumerate(lines):
+        stripped = line.strip()
+        is_boundary = (
+            depth == 0 and not in_block_comment and stripped
+            and not line[0].isspace()
+            and not stripped.startswith(("}", ")", "]") + _ATTACHED_PREFIXES)
+        )
+        code, in_block_comment = _strip_code_line(line, in_block_comment)
+        depth = max(0, depth + code.count("{") - code.count("}"))
+        if is_boundary:
+            boundaries.append(index)
+
+    if not boundaries:
+        return [Unit(None, 1, len(lines))]
+
+    # 定義の直前にあるコメントやデコレータはその定義に含める
+    starts = []
+    previous = -1
+    for index in boundaries:
+        start = index
+        while start - 1 > previous and lines[start - 1].strip().startswith(_ATTACHED_PREFIXES):
+            start -= 1
+        starts.append(start)
+        previous = index
+    starts[0] = 0
+
+    units = []
+    for position, start in enumerate(starts):
+        end = starts[position + 1] if position + 1 < len(starts) else len(lines)
+        units.append(Unit(_symbol_name(lines[boundaries[position]]), start + 1, end))
+    return units
+
+def _python_definitions(body, prefix=""):
+    """関数・クラス・メソッドの定義を (修飾名, 行番号) のリストで返す（入れ子の定義も含む）"""
+    definitions = []
+    for node in body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            name = prefix + node.name
+            definitions.append((name, node.lineno))
+            definitions.extend(_python_definitions(node.body, name + "."))
+        elif isinstance(node, (ast.If, ast.Try, ast.With, ast.AsyncWith)):
+            # if TYPE_CHECKING: や try: の中で定義されているものも拾う
+            for block in ("body", "orelse", "finalbody"):
+                definitions.extend(_python_definitions(getattr(node, block, []), prefix))
+            for handler in getattr(node, "handlers", []):
+                definitions.extend(_python_definitions(handler.body, prefix))
+    return definitions
+
+def _brace_definitions(lines):
+    """キーワード（class / function / def / fn など）で始まる定義と、トップレベルの const / let / var を
+    (名前, 行番号) のリストで返す
+    """
+    definitions = []
+    depth = 0
+    in_block_comment = False
+    for index, line in enumerate(lines):
+        code, in_block_comment = _strip_code_line(line, in_block_comment)
+        match = _SYMBOL_PATTERNS[0].search(code)
+        if not match and depth == 0:
+            match = _SYMBOL_PATTERNS[1].search(code)
+        if match:
+            definitions.append((match.group(1), index + 1))
+        depth = max(0, depth + code.count("{") - code.count("}"))
+    return definitions
+
+def _split_large(lines, unit, chunk_size):
+    """大きすぎる範囲を、少しだけ行を重ねながらチャンクサイズ程度の範囲に分ける"""
+    pieces = []
+    start = unit.start_line
+    while start <= unit.end_line:
+        end = start
+        size = len(lines[start - 1])
+        while end < unit.end_line and size + len(lines[end]) <= chunk_size:
+            size += len(lines[end])
+            end += 1
+        pieces.append(Unit(unit.symbol, start, end))
+        if end >= unit.end_line:
+            break
+        start = max(start + 1, end + 1 - SPLIT_OVERLAP_LINES)
+    return pieces
+
+def _merge_small(lines, units, chunk_size):
+    """隣り合う小さな範囲をチャンクサイズを超えない範囲でまとめる"""
+    merged = []
+    symbols = []
+    size = 0
+    for unit in units:
+        unit_size = len(_text(lines, unit))
+        if merged and size + unit_size <= chunk_size and merged[-1].end_line + 1 == unit.start_line:
+            merged[-1].end_line = unit.end_line
+            size += unit_size
+        else:
+            merged.append(Unit(None, unit.start_line, unit.end_line))
+            symbols.append([])
+            size = unit_size
+        if unit.symbol and unit.symbol not in symbols[-1]:
+            symbols[-1].append(unit.symbol)
+    for unit, names in zip(merged, symbols):
+        unit.symbol = ", ".join(names)
+    return merged
+
+def split_code(text, file_ext, chunk_size):
+    """ソースコードを定義単位のチャンクに分割する
+
+    Pythonは ast で、それ以外の言語は波括弧の深さとインデントで定義の境界を求める。
+    小さな定義はチャンクサイズまでまとめ、大きな定義だけを行単位で分割する。
+
+    各チャンクには、そのチャンクから始まる関数・クラス・メソッドの定義を
+    (名前, 行番号) のリストとして "definitions" に含める（シンボルインデックス用）。
+
+    戻り値: [(チャンク本文, {"symbol", "start_line", "end_line", "definitions"}), ...]
+    """
+    lines = _split_lines(text)
+    if not lines:
+        return []
+    max_chars = int(chunk_size * MAX_CHUNK_RATIO)
+
+    units = None
+    if file_ext == ".py":
+        try:
+            tree = ast.parse(text)
+            units = _python_units(lines, tree.body, "", 1, len(lines), max_chars)
+            definitions = _python_definitions(tree.body)
+        except (SyntaxError, ValueError):
+            units = None
+    if units is None:
+        units = _brace_units(lines)
+        definitions = _brace_definitions(lines)
+
+    sized = []
+    for unit in units:
+        if len(_text(lines, unit)) > max_chars:
+            sized.extend(_split_large(lines, unit, chunk_size))
+        else:
+            sized.append(unit)
+
+    chunks = []
+    for unit in _merge_small(lines, sized, chunk_size):
+        chunk_text = _text(lines, unit)
+        if not chunk_text.strip():
+            continue
+        chunks.append((chunk_text, {
+            "symbol": unit.symbol,
+            "start_line": unit.start_line,
+            "end_line": unit.end_line,
+            "definitions": []
+        }))
+
+    # 定義の行を含む最初のチャンクに割り当てる（チャンクは行番号順に並んでいる）
+    position = 0
+    for name, line in sorted(definitions, key=lambda definition: definition[1]):
+        while position < len(chunks) and chunks[position][1]["end_line"] < line:
+            position += 1
+        if position < len(chunks) and chunks[position][1]["start_line"] <= line:
+            chunks[position][1]["definitions"].append((name, line))
+    return chunks
@@ -1,9 +1,15 @@
 import os
-import glob
-import chromadb
-from chromadb.utils import embedding_functions
+import json
+import hashlib
+import argparse
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+import multiprocessing
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.document_loaders import TextLoader
 import pytesseract
 from PIL import Image
 import io
@@ -11,128 +17,423 @@ import pdfplumber  # PyMuPDFの代わりにpdfplumberを使用
 import re
 import numpy as np
 import cv2
+from embedding_cache import EmbeddingCache
+from ocr_cache import OcrCache
+from repo_walker import walk_files
+from text_loader import load_text
+from code_chunker import split_code
+from lexical_index import LexicalIndex, lexical_index_path
+from symbol_index import SymbolIndex, symbol_index_path
+from collection_alias import ALIAS_FILE_NAME, versioned_name, read_alias, write_alias, next_alias, expired_collections
+# ChromaDBクライアントとエンベディングモデルはクエリ側と共有する（アプリ内では読み込み済みのものを再利用する）
+from code_query import get_client, get_embedding_function, EMBEDDING_MODEL_NAME
 
 # 設定
 SOURCE_CODE_DIR = "/code_repo"  # コンテナ内のソースコードディレクトリ
 DOCS_DIR = os.path.join(SOURCE_CODE_DIR, "docs")  # ドキュメントディレクトリ（後方互換性のため残す）
 CHROMA_PERSIST_DIR = "/app/chroma_db"  # ChromaDBの保存先
-CHROMA_HOST = "chroma"  # ChromaDBのホスト名
-CHROMA_PORT = 8000  # ChromaDBのポート
-COLLECTION_NAME = "code_chunks"  # コレクション名
+COLLECTION_NAME = "code_chunks"  # コレクション名（実際のコレクションは code_chunks_v{n} として作成される）
+ALIAS_PATH = os.path.join(CHROMA_PERSIST_DIR, ALIAS_FILE_NAME)  # 有効なコレクションを指すエイリアスファイル
+COLLECTION_GRACE_PERIOD = 600  # 切り替え後、古いコレクションを削除するまでの猶予（秒）
+EMBEDDING_CACHE_DIR = os.path.join(CHROMA_PERSIST_DIR, "embedding_cache")  # 埋め込みベクトルのキャッシュ保存先
+OCR_CACHE_DIR = os.path.join(CHROMA_PERSIST_DIR, "ocr_cache")  # OCR結果のキャッシュ保存先（Webアプリケーションと共有）
+OCR_LANG = "jpn+eng"  # OCRの言語
+OCR_CONFIG = r"--oem 3 --psm 6 -l jpn+eng"  # Tesseractの設定
+PREPROCESS_VERSION = 4  # preprocess_image などOCRの処理を変えたら上げる（設定値と同様にOCRキャッシュのキーに含まれる）
+OCR_TARGET_DPI = 300  # 解像度情報のある画像はこのDPI相当に拡大・縮小してからOCRする
+OCR_MAX_UPSCALE = 2.0  # 拡大する場合の最大倍率
+OCR_MAX_PIXELS = 4_000_000  # これより画素数の多い画像は縮小する（4K画面のスクリーンショットは約830万画素）
+OCR_MIN_TEXT_HEIGHT = 20  # 縮小しても小さい文字の行の高さ（画素）がこれを下回らないようにする
+OCR_PREFILTER = True  # 文字を含まなそうな画像（写真・ロゴ・無地）はOCRしない（アップロードされた画像には適用しない）
+OCR_MIN_TEXT_REGIONS = 3  # 文字らしい領域がこれ未満ならテキストなしと判定する
+OCR_ANALYSIS_MIN_SCALE = 0.75  # 文字らしい領域を探すときに縮小する下限（8画素の文字が6画素以上に残るようにする）
+OCR_TILE_HEIGHT = None  # 高さがこれを超える画像は横長の帯に分けて並列にOCRする（None で分割しない）
+OCR_TILE_OVERLAP = 64  # 帯の間で縦に重ねる画素数（境界で文字が切れないようにする）
+OCR_TILE_WORKERS = 4  # 帯を並列にOCRするスレッド数（Tesseractは別プロセスで動くためスレッドで並列化できる。プールのワーカー内では1）
 CHUNK_SIZE = 1000  # テキストチャンクのサイズ
-CHUNK_OVERLAP = 200  # チャンク間のオーバーラップ
+CHUNK_OVERLAP = 200  # チャンク間のオーバーラップ（画像・PDFのテキスト分割のみ。コードは定義単位で分割する）
+CHUNK_LOCATION_KEYS = ("symbol", "start_line", "end_line", "page")  # チャンクの代表ファイル内での位置を表すメタデータ
 EXTENSIONS = [".py", ".js", ".ts", ".jsx", ".tsx", ".html", ".css", ".java", ".c", ".cpp", ".h", ".hpp", ".go", ".rs", ".rb", ".php"]  # 対象とするファイル拡張子
 IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png", ".gif", ".bmp"]  # 対象とする画像ファイル拡張子
 PDF_EXTENSIONS = [".pdf"]  # 対象とするPDFファイル拡張子
+EXCLUDE_DIRS = [".git", "node_modules", "__pycache__", "venv", ".venv", "dist", "build", "target", ".tox", ".mypy_cache"]  # 走査しないディレクトリ名
+USE_GITIGNORE = True  # .gitignore で除外されたファイルとディレクトリを対象外にする
+MANIFEST_PATH = os.path.join(CHROMA_PERSIST_DIR, "manifest.json")  # 増分インデックス用のマニフェスト
+INDEX_WORKERS = int(os.environ.get("INDEX_WORKERS", os.cpu_count() or 1))  # ファイル処理の並列ワーカー数（1で逐次処理）
+TEXT_FILES_PER_TASK = 16  # テキストファイルをワーカーに渡す単位（小さなファイルのプロセス間通信を減らす）
+PDF_PAGES_PER_TASK = 16  # PDFをワーカーに分けて渡すときの1タスクあたりのページ数
+PDF_OCR_FALLBACK = True  # テキストレイヤーのないページは画像にしてOCRする
+INDEX_BATCH_SIZE = 256  # ChromaDBに一度に保存するチャンク数
+PIPELINE_QUEUE_SIZE = 4  # パイプラインの各段の間に溜められるバッチ数
+INDEX_MAX_RETRIES = 3  # バッチの保存に失敗した場合の再試行回数
 
 # ディレクトリが存在しない場合は作成
 os.makedirs(CHROMA_PERSIST_DIR, exist_ok=True)
 
-# ChromaDBクライアントの初期化
-client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
-
-# エンベディング関数の初期化
-embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
-    model_name="all-MiniLM-L6-v2"
+# テキスト分割器の初期化
+text_splitter = RecursiveCharacterTextSplitter(
+    chunk_size=CHUNK_SIZE,
+    chunk_overlap=CHUNK_OVERLAP,
+    separators=["\n\n", "\n", " ", ""]
 )
 
-# コレクションの作成または取得
-try:
-    # 既存のコレクションを削除
+def open_active_collection(alias, manifest):
+    """増分更新の書き込み先として、有効なコレクションを取得する
+    
+    エイリアスとマニフェストが食い違っている場合など、増分更新できない場合は None を返す。
+    """
+    if alias is None:
+        print("有効なコレクションがないため、新しいコレクションを作成します")
+        return None
+    if manifest.get("collection") != alias["active"]:
+        print("警告: マニフェストが有効なコレクションと対応していないため、フルリビルドを行います")
+        return None
+    
     try:
-        client.delete_collection(name=COLLECTION_NAME)
-        print(f"既存のコレクション '{COLLECTION_NAME}' を削除しました")
-    except:
+        collection = get_client().get_collection(
+            name=alias["active"],
+            embedding_function=get_embedding_function()
+        )
+    except Exception as e:
+        print(f"警告: コレクション '{alias['active']}' を取得できないため、フルリビルドを行います: {e}")
+        return None
+    
+    if manifest["files"] and collection.count() == 0:
+        print("警告: コレクションが空のため、フルリビルドを行います")
+        return None
+    
+    # 語彙インデックスやシンボルインデックスがない場合、変更のないファイルの分が作れないので作り直す
+    if manifest["files"]:
+        for label, path_fn in (("語彙インデックス", lexical_index_path), ("シンボルインデックス", symbol_index_path)):
+            if not os.path.exists(path_fn(CHROMA_PERSIST_DIR, alias["active"])):
+                print(f"{label}がないため、フルリビルドを行います（埋め込みはキャッシュを使用します）")
+                return None
+    
+    print(f"コレクション '{alias['active']}' を増分更新します")
+    return collection
+
+def create_versioned_collection(alias):
+    """フルリビルド用に新しいバージョンのコレクションを作成する
+    
+    クエリは切り替えが完了するまで有効なコレクションを使い続ける。
+    """
+    version = (alias["version"] if alias else 0) + 1
+    name = versioned_name(COLLECTION_NAME, version)
+    try:
+        # 前回失敗したリビルドの残骸があれば削除
+        try:
+            get_client().delete_collection(name=name)
+            print(f"作成途中のコレクション '{name}' を削除しました")
+        except Exception:
+            pass
+        
+        collection = get_client().create_collection(
+            name=name,
+            embedding_function=get_embedding_function()
+        )
+        print(f"新しいコレクション '{name}' を作成しました")
+        return collection, version
+    except Exception as e:
+        print(f"コレクションの初期化中にエラーが発生しました: {e}")
+        raise
+
+def publish_collection(alias, collection_name, version, index_changed=True):
+    """エイリアスを collection_name に切り替え、猶予期間を過ぎた古いコレクションを削除する"""
+    new_alias = next_alias(alias, collection_name, version, index_changed)
+    
+    # エイリアスにもマニフェストにも記録されていないコレクション（失敗したリビルドの残骸や
+    # バージョン管理前の code_chunks）も退役扱いにして、猶予期間後に削除する
+    known = {collection_name} | {entry["name"] for entry in new_alias["retired"]}
+    for listed in get_client().list_collections():
+        name = getattr(listed, "name", listed)
+        if name not in known and (name == COLLECTION_NAME or name.startswith(f"{COLLECTION_NAME}_v")):
+            new_alias["retired"].append({"name": name, "retired_at": time.time()})
+    
+    expired, new_alias["retired"] = expired_collections(new_alias, COLLECTION_GRACE_PERIOD)
+    write_alias(ALIAS_PATH, new_alias)
+    print(f"有効なコレクションを '{collection_name}' に切り替えました（インデックスバージョン {new_alias['index_version']}）")
+    
+    for name in expired:
+        try:
+            get_client().delete_collection(name=name)
+            print(f"古いコレクション '{name}' を削除しました")
+        except Exception as e:
+            print(f"警告: 古いコレクション '{name}' を削除できませんでした: {e}")
+        # コレクションに付随するファイルも削除
+        for path in (lexical_index_path(CHROMA_PERSIST_DIR, name), symbol_index_path(CHROMA_PERSIST_DIR, name)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def load_manifest():
+    """前回のインデックス作成時のマニフェストを読み込む"""
+    try:
+        with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if isinstance(manifest.get("files"), dict):
+            return manifest
+        print(f"警告: マニフェストの形式が不正です。フルリビルドを行います: {MANIFEST_PATH}")
+    except FileNotFoundError:
         pass
+    except (OSError, ValueError) as e:
+        print(f"警告: マニフェストを読み込めませんでした。フルリビルドを行います: {e}")
+    return {"collection": None, "files": {}}
+
+def save_manifest(manifest):
+    """マニフェストをアトミックに書き込む"""
+    tmp_path = MANIFEST_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+def file_content_hash(file_path):
+    """ファイル内容のSHA-256ハッシュを計算"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def plan_incremental_update(file_paths, manifest):
+    """マニフェストと比較して、処理が必要なファイルと削除されたファイルを求める
+    
+    戻り値は (changed, removed)。changed は (file_path, rel_path, stat情報) のリスト、
+    removed はリポジトリから消えたファイルの相対パスのリスト。
+    mtimeとサイズが一致するファイルはハッシュ計算も行わずにスキップする。
+    """
+    known_files = manifest["files"]
+    changed = []
+    seen = set()
+    
+    for file_path in file_paths:
+        rel_path = os.path.relpath(file_path, SOURCE_CODE_DIR)
+        if rel_path in seen:
+            continue
+        seen.add(rel_path)
+        
+        try:
+            stat = os.stat(file_path)
+        except OSError as e:
+            print(f"警告: {rel_path} の情報を取得できませんでした: {e}")
+            continue
+        
+        entry = known_files.get(rel_path)
+        if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+            continue
+        
+        content_hash = file_content_hash(file_path)
+        if entry and entry["hash"] == content_hash:
+            # 内容が同じならタイムスタンプだけ更新して再処理しない
+            entry["mtime"] = stat.st_mtime
+            entry["size"] = stat.st_size
+            continue
+        
+        changed.append((file_path, rel_path, {
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "hash": content_hash
+        }))
     
-    # 新しいコレクションを作成
-    collection = client.create_collection(
-        name=COLLECTION_NAME,
-        embedding_function=embedding_function
+    removed = [rel_path for rel_path in known_files if rel_path not in seen]
+    return changed, removed
+
+def chunk_id_for(content):
+    """チャンク本文のハッシュから求めるチャンクID（同じ内容のチャンクはファイルをまたいで1つにまとめる）"""
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:32]
+
+def build_chunk_refs(manifest):
+    """マニフェストから、チャンクIDごとにそのチャンクを含むファイルの集合を求める"""
+    chunk_refs = {}
+    for rel_path, file_info in manifest["files"].items():
+        for chunk_id in file_info.get("chunk_ids", []):
+            chunk_refs.setdefault(chunk_id, set()).add(rel_path)
+    return chunk_refs
+
+def discover_files():
+    """ソースコードディレクトリを1回だけ走査し、(コードファイル, ドキュメントファイル) のパスを返す"""
+    found = walk_files(
+        SOURCE_CODE_DIR,
+        EXTENSIONS + IMAGE_EXTENSIONS + PDF_EXTENSIONS,
+        exclude_dirs=EXCLUDE_DIRS,
+        use_gitignore=USE_GITIGNORE
     )
-    print(f"新しいコレクション '{COLLECTION_NAME}' を作成しました")
-except Exception as e:
-    print(f"コレクションの初期化中にエラーが発生しました: {e}")
-    raise
+    code_files = [path for ext in EXTENSIONS for path in found[ext]]
+    doc_files = [path for ext in IMAGE_EXTENSIONS + PDF_EXTENSIONS for path in found[ext]]
+    return code_files, doc_files
 
-# テキスト分割器の初期化
-text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=CHUNK_SIZE,
-    chunk_overlap=CHUNK_OVERLAP,
-    separators=["\n\n", "\n", " ", ""]
-)
+def find_text_lines(img_array):
+    """文字列らしい領域（横長で高さが小さく、中身が詰まった領域）の高さを、元の画像の画素数で返す
+    
+    長辺1000画素を目安に縮小した画像（ただし OCR_ANALYSIS_MIN_SCALE 倍より小さくはしない）の
+    輪郭を横方向につなげて調べる。写真や無地の画像、ロゴだけの画像ではほとんど見つからない。
+    """
+    height, width = img_array.shape[:2]
+    scale = min(1.0, max(1000.0 / max(height, width), OCR_ANALYSIS_MIN_SCALE))
+    small = cv2.resize(img_array, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1.0 else img_array
+    
+    gradient = cv2.morphologyEx(small, cv2.MORPH_GRADIENT, np.ones((3, 3), np.uint8))
+    _, edges = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    if not edges.any():
+        return np.zeros(0)
+    joined = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (9, 1)))
+    _, _, stats, _ = cv2.connectedComponentsWithStats(joined, connectivity=8)
+    
+    widths = stats[1:, cv2.CC_STAT_WIDTH]
+    heights = stats[1:, cv2.CC_STAT_HEIGHT]
+    fill = stats[1:, cv2.CC_STAT_AREA] / np.maximum(widths * heights, 1)
+    text_like = (heights >= 6) & (heights <= small.shape[0] * 0.25) & (widths >= heights * 1.5) & (fill >= 0.4)
+    return heights[text_like] / scale
 
-def get_all_code_files():
-    """対象となるすべてのコードファイルのパスを取得"""
-    all_files = []
-    for ext in EXTENSIONS:
-        pattern = os.path.join(SOURCE_CODE_DIR, f"**/*{ext}")
-        all_files.extend(glob.glob(pattern, recursive=True))
-    return all_files
-
-def get_all_doc_files():
-    """ソースコード内のすべての画像とPDFファイルのパスを取得"""
-    all_files = []
-    
-    # 画像ファイルを取得
-    for ext in IMAGE_EXTENSIONS:
-        pattern = os.path.join(SOURCE_CODE_DIR, f"**/*{ext}")
-        found_files = glob.glob(pattern, recursive=True)
-        print(f"画像検索パターン {pattern} で {len(found_files)} ファイルが見つかりました")
-        print(f"見つかったファイル: {found_files}")
-        all_files.extend(found_files)
-    
-    # PDFファイルを取得
-    for ext in PDF_EXTENSIONS:
-        pattern = os.path.join(SOURCE_CODE_DIR, f"**/*{ext}")
-        found_files = glob.glob(pattern, recursive=True)
-        print(f"PDF検索パターン {pattern} で {len(found_files)} ファイルが見つかりました")
-        print(f"見つかったファイル: {found_files}")
-        all_files.extend(found_files)
-    
-    print(f"合計で {len(all_files)} 個のドキュメントファイルが見つかりました")
-    print(f"ファイル一覧: {all_files}")
-    return all_files
+def likely_has_text(text_line_heights):
+    """文字を含みそうな画像かどうか（find_text_lines で見つかった領域が OCR_MIN_TEXT_REGIONS 以上あるか）"""
+    return len(text_line_heights) >= OCR_MIN_TEXT_REGIONS
+
+def ocr_scale(image, text_line_heights):
+    """OCRに適した解像度にするための拡大・縮小率
+    
+    解像度情報 (DPI) がある画像は OCR_TARGET_DPI 相当に合わせ、画素数が OCR_MAX_PIXELS を
+    超える場合は縮小する。ただし小さい方の文字の行の高さが OCR_MIN_TEXT_HEIGHT を下回るほどは縮小しない。
+    """
+    scale = 1.0
+    dpi = image.info.get("dpi")
+    if dpi and dpi[0] and float(dpi[0]) > 0:
+        scale = min(OCR_TARGET_DPI / float(dpi[0]), OCR_MAX_UPSCALE)
+    pixels = image.size[0] * image.size[1] * scale * scale
+    if pixels > OCR_MAX_PIXELS:
+        min_scale = 0.0
+        if len(text_line_heights):
+            min_scale = min(scale, OCR_MIN_TEXT_HEIGHT / float(np.percentile(text_line_heights, 10)))
+        scale = max(scale * (OCR_MAX_PIXELS / pixels) ** 0.5, min_scale)
+    return scale
 
 def preprocess_image(image):
-    """OCRの精度を向上させるための画像前処理"""
+    """OCRの精度を向上させるための画像前処理
+    
+    戻り値: (前処理済みのグレースケールの numpy 配列, find_text_lines で見つかった文字列らしい領域の高さ)
+    """
     # グレースケールに変換
     if image.mode != 'L':
         image = image.convert('L')
+    img_array = np.asarray(image)
+    text_line_heights = find_text_lines(img_array)
     
-    # PILからnumpyに変換
-    img_array = np.array(image)
+    # OCRに適した解像度に拡大・縮小
+    scale = ocr_scale(image, text_line_heights)
+    if abs(scale - 1.0) > 0.05:
+        interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_CUBIC
+        img_array = cv2.resize(img_array, None, fx=scale, fy=scale, interpolation=interpolation)
     
     # ノイズ除去（メディアンフィルタ）
     img_array = cv2.medianBlur(img_array, 3)
     
     # コントラスト強調
-    img_array = cv2.equalizeHist(img_array)
+    return cv2.equalizeHist(img_array), text_line_heights
+
+def split_tiles(img_array):
+    """縦に長い画像を、少しずつ縦に重なる横幅いっぱいの帯に分ける（上から順）"""
+    height = img_array.shape[0]
+    if not OCR_TILE_HEIGHT or height <= OCR_TILE_HEIGHT:
+        return [img_array]
+    step = OCR_TILE_HEIGHT - OCR_TILE_OVERLAP
+    return [img_array[top:top + OCR_TILE_HEIGHT] for top in range(0, height - OCR_TILE_OVERLAP, step)]
+
+def join_tile_texts(texts):
+    """帯ごとのOCR結果を上から順につなげる。重なり部分で両方の帯に出た行は1回だけにする"""
+    lines = []
+    for text in texts:
+        tile_lines = [line for line in text.splitlines() if line.strip()]
+        overlap = 0
+        for size in range(min(len(lines), len(tile_lines)), 0, -1):
+            if lines[-size:] == tile_lines[:size]:
+                overlap = size
+                break
+        lines.extend(tile_lines[overlap:])
+    return "\n".join(lines)
+
+def ocr_array(img_array):
+    """前処理済みの画像をOCRする。縦に長い画像は帯ごとに並列にOCRして結合する"""
+    tiles = split_tiles(img_array)
+    run = lambda tile: pytesseract.image_to_string(Image.fromarray(tile), lang=OCR_LANG, config=OCR_CONFIG)
+    if len(tiles) == 1:
+        return run(tiles[0])
+    print(f"{len(tiles)}つの帯に分けてOCRします")
+    with ThreadPoolExecutor(max_workers=min(OCR_TILE_WORKERS, len(tiles))) as tile_executor:
+        return join_tile_texts(tile_executor.map(run, tiles))
+
+_ocr_cache = None
+
+def get_ocr_cache():
+    """プロセスごとのOCRキャッシュ（初回呼び出し時に作成）"""
+    global _ocr_cache
+    if _ocr_cache is None:
+        _ocr_cache = OcrCache(OCR_CACHE_DIR)
+    return _ocr_cache
+
+def ocr_settings():
+    """OCRの結果を左右する設定を文字列にまとめる（OCRキャッシュのキーに含め、設定を変えたら再OCRされるようにする）"""
+    return json.dumps({
+        "preprocess_version": PREPROCESS_VERSION,
+        "target_dpi": OCR_TARGET_DPI,
+        "max_upscale": OCR_MAX_UPSCALE,
+        "max_pixels": OCR_MAX_PIXELS,
+        "min_text_height": OCR_MIN_TEXT_HEIGHT,
+        "prefilter": OCR_PREFILTER,
+        "min_text_regions": OCR_MIN_TEXT_REGIONS,
+        "analysis_min_scale": OCR_ANALYSIS_MIN_SCALE,
+        "tile_height": OCR_TILE_HEIGHT,
+        "tile_overlap": OCR_TILE_OVERLAP
+    }, sort_keys=True)
+
+def extract_image_text(image_bytes, prefilter=OCR_PREFILTER):
+    """画像のバイト列を前処理してOCRする。同じ画像・設定の結果はキャッシュから返す
     
-    # numpyからPILに戻す
-    return Image.fromarray(img_array)
+    prefilter が真なら、文字を含まなそうな画像はOCRせずに空のテキストを返す。
+    戻り値: (抽出したテキスト, キャッシュヒットしたか)
+    """
+    def ocr():
+        image = Image.open(io.BytesIO(image_bytes))
+        print(f"画像サイズ: {image.size}")
+        processed_image, text_line_heights = preprocess_image(image)
+        # 文字を含まなそうな画像はOCRしない（判定を誤っても次回やり直せるようにキャッシュしない）
+        if prefilter and not likely_has_text(text_line_heights):
+            print("文字を含まない画像と判定したため、OCRをスキップします")
+            return None
+        print("OCR処理開始...")
+        return ocr_array(processed_image)
+    
+    return get_ocr_cache().get_or_compute(image_bytes, OCR_LANG, OCR_CONFIG, ocr_settings(), ocr)
+
+def extract_image_text_task(image_bytes, prefilter=OCR_PREFILTER):
+    """プロセスプールで実行する extract_image_text
+    
+    pytesseract の例外の中には親プロセスで復元できないものがあり、プールが壊れてしまうため
+    RuntimeError に置き換えて返す。
+    """
+    try:
+        return extract_image_text(image_bytes, prefilter)
+    except Exception as e:
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+
+def cached_image_text(image_bytes):
+    """OCRキャッシュにあればテキストを返す（OCRは実行しない）。ない場合は None"""
+    cache = get_ocr_cache()
+    return cache.get(cache.key(image_bytes, OCR_LANG, OCR_CONFIG, ocr_settings()))
 
 def process_image(file_path):
-    """画像ファイルからテキストを抽出してドキュメントを作成"""
+    """画像ファイルからテキストを抽出してドキュメントを作成。処理に失敗した場合は None"""
     try:
         print(f"画像処理開始: {file_path}")
         # ファイルの相対パスを取得（メタデータ用）
         rel_path = os.path.relpath(file_path, SOURCE_CODE_DIR)
         print(f"相対パス: {rel_path}")
         
-        # 画像を読み込む
-        image = Image.open(file_path)
-        print(f"画像サイズ: {image.size}")
-        
-        # 画像の前処理
-        processed_image = preprocess_image(image)
-        
-        # OCRの設定
-        custom_config = r'--oem 3 --psm 6 -l jpn+eng'
-        
-        # 画像からテキストを抽出
-        print("OCR処理開始...")
-        extracted_text = pytesseract.image_to_string(processed_image, lang='jpn+eng', config=custom_config)
+        # 画像を読み込み、テキストを抽出（前回と同じ画像ならOCRキャッシュから取得）
+        with open(file_path, "rb") as f:
+            image_bytes = f.read()
+        extracted_text, cached = extract_image_text(image_bytes)
+        if cached:
+            print("OCRキャッシュから取得しました")
         print(f"抽出されたテキスト: {extracted_text[:100]}...")
         
         # 空のテキストの場合はスキップ
@@ -160,126 +461,640 @@ def process_image(file_path):
         print(f"エラー: {file_path}の処理中に問題が発生しました: {e}")
         import traceback
         print(traceback.format_exc())
-        return []
+        return None
 
 def process_file(file_path):
-    """ファイルを読み込み、チャンクに分割してドキュメントを作成"""
+    """ファイルを読み込み、チャンクに分割してドキュメントを作成。処理に失敗した場合は None"""
     try:
         # ファイルの相対パスを取得（メタデータ用）
         rel_path = os.path.relpath(file_path, SOURCE_CODE_DIR)
         
-        # ファイルを読み込む
-        loader = TextLoader(file_path)
-        documents = loader.load()
-        
-        # 各ドキュメントにファイルパスのメタデータを追加
-        for doc in documents:
-            doc.metadata["source"] = rel_path
-            doc.metadata["file_path"] = file_path
+        # ファイルを読み込む（バイナリ・minify・自動生成・サイズ超過のファイルはスキップ）
+        text, reason = load_text(file_path)
+        if text is None:
+            print(f"スキップ: {rel_path} - {reason}")
+            return []
         
-        # ドキュメントをチャンクに分割
-        chunks = text_splitter.split_documents(documents)
+        # 関数・クラスなどの定義単位でチャンクに分割し、シンボル名と行範囲をメタデータに付ける
+        from langchain.schema import Document
+        file_ext = os.path.splitext(file_path)[1].lower()
+        chunks = [
+            Document(
+                page_content=chunk_text,
+                metadata={
+                    "source": rel_path,
+                    "file_path": file_path,
+                    **chunk_metadata
+                }
+            )
+            for chunk_text, chunk_metadata in split_code(text, file_ext, CHUNK_SIZE)
+        ]
         
         print(f"処理中: {rel_path} - {len(chunks)}チャンクに分割")
         return chunks
     except Exception as e:
         print(f"エラー: {file_path}の処理中に問題が発生しました: {e}")
-        return []
+        return None
+
+def extract_pdf_page_text(page):
+    """PDFの1ページからテキストを抽出する。テキストレイヤーがなければページ画像をOCRする"""
+    page_text = page.extract_text() or ""
+    if page_text.strip() or not PDF_OCR_FALLBACK:
+        return page_text
+    try:
+        image = page.to_image(resolution=OCR_TARGET_DPI).original
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        page_text, _ = extract_image_text(buffer.getvalue())
+        return page_text
+    except Exception as e:
+        # 空のページとして扱うと次回も再処理されないので、PDF全体を失敗として扱う
+        print(f"警告: {page.page_number}ページのOCRに失敗しました: {e}")
+        raise
 
-def process_pdf(file_path):
-    """PDFファイルからテキストを抽出してドキュメントを作成"""
+def process_pdf(file_path, first_page=None, last_page=None):
+    """PDFファイルからページごとにテキストを抽出してドキュメントを作成
+    
+    first_page, last_page（1始まり、終端を含む）を指定するとその範囲のページだけを処理する。
+    ページは1枚ずつ読み込んで解放し、チャンクには page メタデータを付ける。
+    処理に失敗した場合（OCRに失敗したページがある場合を含む）は None を返す。
+    """
     try:
         # ファイルの相対パスを取得（メタデータ用）
         rel_path = os.path.relpath(file_path, SOURCE_CODE_DIR)
         
-        # PDFを開く
-        extracted_text = ""
-        with pdfplumber.open(file_path) as pdf:
-            # すべてのページからテキストを抽出
+        from langchain.schema import Document
+        page_numbers = list(range(first_page, last_page + 1)) if first_page else None
+        chunks = []
+        with pdfplumber.open(file_path, pages=page_numbers) as pdf:
             for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    extracted_text += page_text + "\n\n"
+                page_text = extract_pdf_page_text(page)
+                if page_text.strip():
+                    doc = Document(
+                        page_content=page_text,
+                        metadata={
+                            "source": rel_path,
+                            "file_path": file_path,
+                            "type": "pdf",
+                            "page": page.page_number
+                        }
+                    )
+                    chunks.extend(text_splitter.split_documents([doc]))
+                # 処理したページのキャッシュを解放する
+                page.close()
         
         # 空のテキストの場合はスキップ
-        if not extracted_text.strip():
+        if not chunks:
             print(f"警告: {rel_path} からテキストを抽出できませんでした")
             return []
         
-        # ドキュメントを作成
-        from langchain.schema import Document
-        doc = Document(
-            page_content=extracted_text,
-            metadata={
-                "source": rel_path,
-                "file_path": file_path,
-                "type": "pdf"
-            }
-        )
-        
-        # ドキュメントをチャンクに分割
-        chunks = text_splitter.split_documents([doc])
-        
-        print(f"処理中: {rel_path} - {len(chunks)}チャンクに分割")
+        page_range = f" ({first_page}-{last_page}ページ)" if first_page else ""
+        print(f"処理中: {rel_path}{page_range} - {len(chunks)}チャンクに分割")
         return chunks
     except Exception as e:
         print(f"エラー: {file_path}の処理中に問題が発生しました: {e}")
-        return []
+        return None
 
-def main():
-    all_chunks = []
-    
-    # すべてのコードファイルを取得して処理
-    code_files = get_all_code_files()
-    print(f"{len(code_files)}個のコードファイルが見つかりました")
+def count_pdf_pages(file_path):
+    """PDFのページ数。開けない場合は 0"""
+    try:
+        with pdfplumber.open(file_path) as pdf:
+            return len(pdf.pages)
+    except Exception as e:
+        print(f"警告: {file_path} のページ数を取得できませんでした: {e}")
+        return 0
+
+def process_path(file_path):
+    """拡張子に応じた処理関数でファイルをチャンクに分割
+
+    戻り値はチャンクのリスト。スキップしたファイルやテキストのないファイルは空のリスト、
+    処理に失敗したファイルは None（マニフェストに記録せず、次回再試行する）。
+    """
+    file_ext = os.path.splitext(file_path)[1].lower()
+    if file_ext in IMAGE_EXTENSIONS:
+        return process_image(file_path)
+    if file_ext in PDF_EXTENSIONS:
+        return process_pdf(file_path)
+    return process_file(file_path)
+
+def _init_worker():
+    """ワーカープロセスの初期化。Tesseractの内部スレッドや帯の並列OCRでコアを奪い合わないようにする"""
+    global OCR_TILE_WORKERS
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+    OCR_TILE_WORKERS = 1
+
+def create_worker_pool(workers=INDEX_WORKERS):
+    """ファイル処理用のプロセスプールを作成する
     
-    for file_path in code_files:
-        chunks = process_file(file_path)
-        all_chunks.extend(chunks)
+    スレッドやモデルを抱えた常駐プロセス（Webアプリ）から使っても安全なように spawn で起動する。
+    起動コストがかかるため、常駐プロセスではプールを使い回すこと。
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker
+    )
+
+def process_paths(items):
+    """複数のファイルを順に処理し、ファイルごとのチャンクのリストを返す（ワーカー用）
     
-    # すべてのドキュメントファイル（画像とPDF）を取得して処理
-    doc_files = get_all_doc_files()
-    print(f"{len(doc_files)}個のドキュメントファイルが見つかりました")
+    要素はファイルパス、または PDF のページ範囲 (ファイルパス, 開始ページ, 終了ページ)。
+    """
+    return [
+        process_pdf(*item) if isinstance(item, tuple) else process_path(item)
+        for item in items
+    ]
+
+def _make_tasks(file_paths):
+    """ファイルをワーカーに渡すタスクにまとめる
     
-    for file_path in doc_files:
+    OCRとPDF抽出は時間のかかるものとして先に並べ、画像は1ファイル1タスク、PDFは
+    PDF_PAGES_PER_TASK ページずつのページ範囲 (ファイルパス, 開始ページ, 終了ページ) に分けて
+    複数のワーカーで並列に処理する。テキストファイルはプロセス間通信を減らすために
+    TEXT_FILES_PER_TASK 件ずつまとめる。
+    """
+    doc_tasks = []
+    text_paths = []
+    for file_path in file_paths:
         file_ext = os.path.splitext(file_path)[1].lower()
+        if file_ext in PDF_EXTENSIONS:
+            page_count = count_pdf_pages(file_path)
+            if page_count > PDF_PAGES_PER_TASK:
+                doc_tasks.extend(
+                    [(file_path, first_page, min(first_page + PDF_PAGES_PER_TASK - 1, page_count))]
+                    for first_page in range(1, page_count + 1, PDF_PAGES_PER_TASK)
+                )
+            else:
+                doc_tasks.append([file_path])
+        elif file_ext in IMAGE_EXTENSIONS:
+            doc_tasks.append([file_path])
+        else:
+            text_paths.append(file_path)
+    text_tasks = [
+        text_paths[start:start + TEXT_FILES_PER_TASK]
+        for start in range(0, len(text_paths), TEXT_FILES_PER_TASK)
+    ]
+    return doc_tasks + text_tasks
+
+def iter_processed_files(file_paths, workers=INDEX_WORKERS, executor=None):
+    """ファイルを並列に処理し、タスク順に (file_path, chunks) を順次返す
+    
+    処理に失敗したファイルの chunks は None（PDFはいずれかのページ範囲が失敗した場合）。
+    
+    処理中のタスク数を workers * 2 までに制限し、消費が追いつかない場合は
+    新しいタスクを投入しない。結果は完了順ではなくタスク順に返すため、
+    並列度によって出力の順序は変わらない。executor を渡した場合はそのプールを使い、
+    渡さない場合はこの呼び出しの間だけプールを作成する。
+    """
+    if executor is None and workers <= 1:
+        for file_path in file_paths:
+            yield file_path, process_path(file_path)
+        return
+    
+    if executor is None:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as own_executor:
+            yield from iter_processed_files(file_paths, workers, own_executor)
+        return
+    
+    tasks = iter(_make_tasks(file_paths))
+    pending = deque()
+    # ページ範囲に分けたPDFは、最後の範囲が終わるまでチャンクをためてから1ファイルとして返す
+    partial_path = None
+    partial_chunks = []
+    try:
+        for task in islice(tasks, workers * 2):
+            pending.append((task, executor.submit(process_paths, task)))
         
-        if file_ext in IMAGE_EXTENSIONS:
-            chunks = process_image(file_path)
-            all_chunks.extend(chunks)
-        elif file_ext in PDF_EXTENSIONS:
-            chunks = process_pdf(file_path)
-            all_chunks.extend(chunks)
-    
-    print(f"合計{len(all_chunks)}チャンクを処理しました")
-    
-    # ChromaDBにデータを保存
-    if all_chunks:
-        # ChromaDBに追加するためのデータを準備
-        ids = []
-        texts = []
-        metadatas = []
-        
-        for i, chunk in enumerate(all_chunks):
-            chunk_id = f"chunk_{i}"
-            ids.append(chunk_id)
-            texts.append(chunk.page_content)
-            metadatas.append({
-                "source": chunk.metadata.get("source", "Unknown"),
-                "file_path": chunk.metadata.get("file_path", "Unknown"),
-                "type": chunk.metadata.get("type", "code")
-            })
+        while pending:
+            task, future = pending.popleft()
+            results = future.result()
+            next_task = next(tasks, None)
+            if next_task is not None:
+                pending.append((next_task, executor.submit(process_paths, next_task)))
+            for item, chunks in zip(task, results):
+                # 同じPDFのページ範囲はタスク順で連続しているので、別のファイルに移った時点で返す
+                is_page_range = isinstance(item, tuple)
+                if partial_path is not None and (not is_page_range or item[1] == 1):
+                    yield partial_path, partial_chunks
+                    partial_path = None
+                    partial_chunks = []
+                if is_page_range:
+                    partial_path = item[0]
+                    if chunks is None or partial_chunks is None:
+                        partial_chunks = None
+                    else:
+                        partial_chunks.extend(chunks)
+                else:
+                    yield item, chunks
         
-        # ChromaDBにデータを追加
-        collection.add(
-            ids=ids,
-            documents=texts,
-            metadatas=metadatas
+        if partial_path is not None:
+            yield partial_path, partial_chunks
+    finally:
+        # 途中で中断された場合は、まだ始まっていないタスクを取り消す
+        for _, future in pending:
+            future.cancel()
+
+def with_retries(func, description, max_retries=INDEX_MAX_RETRIES):
+    """一時的なエラーに備えて、指数バックオフで関数を再試行する"""
+    for attempt in range(max_retries + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            wait = 2 ** attempt
+            print(f"警告: {description}に失敗しました（{attempt + 1}回目）。{wait}秒後に再試行します: {e}")
+            time.sleep(wait)
+
+def _new_batch():
+    return {"ids": [], "documents": [], "metadatas": []}
+
+_END_OF_STREAM = object()
+
+class BatchWriter:
+    """チャンクのバッチを埋め込み、ChromaDBに保存するスレッドパイプライン
+    
+    embed → upsert の各段はサイズ制限付きのキューでつながっており、下流が詰まると
+    put() がブロックしてファイルの読み込みを止める（バックプレッシャー）。
+    メモリに載るのは高々 PIPELINE_QUEUE_SIZE 個程度のバッチだけになる。
+    """
+    
+    def __init__(self, collection, embedding_cache=None, queue_size=PIPELINE_QUEUE_SIZE):
+        self.collection = collection
+        self.embedding_cache = embedding_cache
+        self.saved = 0
+        self.errors = []
+        self._embed_queue = queue.Queue(maxsize=queue_size)
+        self._upsert_queue = queue.Queue(maxsize=queue_size)
+        self._threads = [
+            threading.Thread(
+                target=self._run_stage,
+                args=(self._embed, self._embed_queue, self._upsert_queue),
+                name="index-embed",
+                daemon=True
+            ),
+            threading.Thread(
+                target=self._run_stage,
+                args=(self._upsert, self._upsert_queue, None),
+                name="index-upsert",
+                daemon=True
+            ),
+        ]
+        for thread in self._threads:
+            thread.start()
+    
+    def _run_stage(self, func, inbox, outbox):
+        while True:
+            item = inbox.get()
+            if item is _END_OF_STREAM:
+                break
+            if self.errors:
+                # エラー後も上流がブロックしないように読み捨てる
+                continue
+            try:
+                result = func(item)
+            except Exception as e:
+                self.errors.append(e)
+                continue
+            if outbox is not None:
+                outbox.put(result)
+        if outbox is not None:
+            outbox.put(_END_OF_STREAM)
+    
+    def _embed(self, batch):
+        # キャッシュがあれば、内容が変わっていないチャンクはモデルを通さない
+        if self.embedding_cache is not None:
+            embeddings = self.embedding_cache.embed(batch["documents"], get_embedding_function())
+        else:
+            embeddings = get_embedding_function()(batch["documents"])
+        batch["embeddings"] = np.asarray(embeddings, dtype=np.float32).tolist()
+        return batch
+    
+    def _upsert(self, batch):
+        with_retries(
+            lambda: self.collection.upsert(**batch),
+            f"{len(batch['ids'])}チャンクの保存"
         )
+        self.saved += len(batch["ids"])
+        print(f"ChromaDBに{self.saved}チャンクを保存しました")
+    
+    def put(self, batch):
+        """バッチをパイプラインに投入する。下流のエラーはここで送出する"""
+        if self.errors:
+            raise self.errors[0]
+        self._embed_queue.put(batch)
+    
+    def close(self):
+        """残りのバッチの処理を待ち、エラーがあれば送出する"""
+        self._embed_queue.put(_END_OF_STREAM)
+        for thread in self._threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            # 呼び出し側のエラーを優先し、スレッドの終了だけを待つ
+            self.errors.append(exc)
+            self._embed_queue.put(_END_OF_STREAM)
+            for thread in self._threads:
+                thread.join()
+            return False
+        self.close()
+        return False
+
+def delete_chunks(collection, chunk_ids, batch_size=INDEX_BATCH_SIZE):
+    """チャンクをバッチ単位でChromaDBから削除"""
+    for start in range(0, len(chunk_ids), batch_size):
+        batch_ids = chunk_ids[start:start + batch_size]
+        with_retries(lambda: collection.delete(ids=batch_ids), f"{len(batch_ids)}チャンクの削除")
+
+def update_chunk_sources(collection, chunk_ids, chunk_refs, fresh_metadata, batch_size=INDEX_BATCH_SIZE):
+    """参照元のファイルが変わったチャンクのメタデータ (sources, source, file_path) を更新する
+    
+    今回処理したファイルで保存済みの内容と同じだったチャンクはそのときのメタデータを、
+    それ以外はChromaDBに保存済みのメタデータを元にする。
+    """
+    updated = 0
+    for start in range(0, len(chunk_ids), batch_size):
+        batch_ids = chunk_ids[start:start + batch_size]
+        stored_ids = [chunk_id for chunk_id in batch_ids if chunk_id not in fresh_metadata]
+        base_metadata = {chunk_id: fresh_metadata[chunk_id] for chunk_id in batch_ids if chunk_id in fresh_metadata}
+        if stored_ids:
+            fetched = with_retries(
+                lambda: collection.get(ids=stored_ids, include=["metadatas"]),
+                f"{len(stored_ids)}チャンクのメタデータ取得"
+            )
+            base_metadata.update(zip(fetched["ids"], fetched["metadatas"]))
         
-        print(f"ChromaDBに{len(all_chunks)}チャンクを保存しました")
+        update_ids = []
+        update_metadatas = []
+        for chunk_id in batch_ids:
+            if chunk_id not in base_metadata:
+                continue
+            sources = sorted(chunk_refs[chunk_id])
+            metadata = dict(base_metadata[chunk_id])
+            metadata["sources"] = "\n".join(sources)
+            # 代表のファイルが削除された場合は残っているファイルに付け替える。行範囲・シンボル名・ページは
+            # 元のファイルでの位置なので、付け替え先では正しくない（update は指定したキーだけを更新するので None で消す）
+            if metadata.get("source") not in chunk_refs[chunk_id]:
+                metadata["source"] = sources[0]
+                metadata["file_path"] = os.path.join(SOURCE_CODE_DIR, sources[0])
+                for key in CHUNK_LOCATION_KEYS:
+                    metadata[key] = None
+            update_ids.append(chunk_id)
+            update_metadatas.append(metadata)
+        
+        if update_ids:
+            with_retries(
+                lambda: collection.update(ids=update_ids, metadatas=update_metadatas),
+                f"{len(update_ids)}チャンクのメタデータ更新"
+            )
+            updated += len(update_ids)
+    return updated
+
+class IndexingCancelled(Exception):
+    """インデックス作成がキャンセルされた"""
+
+class IndexProgress:
+    """インデックス作成の進捗。別スレッドから snapshot() で読み取れる"""
+    
+    def __init__(self):
+        self.phase = "starting"
+        self.started_at = time.time()
+        self.files_discovered = 0
+        self.files_to_process = 0
+        self.files_processed = 0
+        self.bytes_to_process = 0
+        self.bytes_read = 0
+        self.chunks = 0
+    
+    def snapshot(self):
+        elapsed = max(time.time() - self.started_at, 1e-6)
+        eta = None
+        if self.bytes_read > 0 and self.bytes_to_process > self.bytes_read:
+            eta = elapsed * (self.bytes_to_process - self.bytes_read) / self.bytes_read
+        elif self.files_processed > 0 and self.files_to_process > self.files_processed:
+            eta = elapsed * (self.files_to_process - self.files_processed) / self.files_processed
+        return {
+            "phase": self.phase,
+            "files_discovered": self.files_discovered,
+            "files_to_process": self.files_to_process,
+            "files_processed": self.files_processed,
+            "bytes_read": self.bytes_read,
+            "chunks": self.chunks,
+            "chunks_per_second": self.chunks / elapsed,
+            "eta_seconds": eta
+        }
+
+def _check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise IndexingCancelled("インデックス作成がキャンセルされました")
+
+def main(full_rebuild=False, workers=INDEX_WORKERS, progress=None, cancel_event=None, executor=None):
+    """インデックスを作成する
+    
+    progress に IndexProgress を渡すと進捗を更新し、cancel_event がセットされると
+    IndexingCancelled を送出して中断する（有効なコレクションは切り替わらない）。
+    executor を渡すとファイル処理にそのプロセスプールを使う。
+    """
+    progress = progress or IndexProgress()
+    alias = read_alias(ALIAS_PATH)
+    manifest = load_manifest()
+    
+    # 増分更新は有効なコレクションに直接書き込み、フルリビルドは新しいバージョンに書き込む
+    collection = None if full_rebuild else open_active_collection(alias, manifest)
+    new_collection = collection is None
+    if not new_collection:
+        version = alias["version"]
     else:
-        print("保存するチャンクがありません")
+        collection, version = create_versioned_collection(alias)
+        manifest = {"collection": collection.name, "files": {}}
+    
+    # すべてのコードファイルとドキュメントファイル（画像とPDF）を取得
+    progress.phase = "discovering"
+    code_files, doc_files = discover_files()
+    print(f"{len(code_files)}個のコードファイルが見つかりました")
+    print(f"{len(doc_files)}個のドキュメントファイルが見つかりました")
+    
+    # 前回から変更されたファイルと削除されたファイルを求める
+    progress.files_discovered = len(code_files) + len(doc_files)
+    _check_cancelled(cancel_event)
+    changed, removed = plan_incremental_update(code_files + doc_files, manifest)
+    print(f"変更: {len(changed)}ファイル, 削除: {len(removed)}ファイル")
+    progress.files_to_process = len(changed)
+    progress.bytes_to_process = sum(file_info["size"] for _, _, file_info in changed)
+    
+    # チャンクIDは本文のハッシュなので、同じ内容のチャンクは複数のファイルから参照される。
+    # 参照元が変わったチャンクを記録し、最後に参照がなくなったものを削除、残りは参照元を更新する
+    chunk_refs = build_chunk_refs(manifest)
+    stored_ids = set(chunk_refs)
+    touched_ids = set()
+    
+    def release(rel_path, chunk_ids):
+        for chunk_id in chunk_ids:
+            chunk_refs.get(chunk_id, set()).discard(rel_path)
+            touched_ids.add(chunk_id)
+    
+    # BM25用の語彙インデックスとシンボルインデックスもコレクションと同じ内容に保つ。
+    # 新しいコレクションでは、同じ名前で残っているファイル（公開されなかった失敗した実行の残骸など）を読み込まない
+    lexical_path = lexical_index_path(CHROMA_PERSIST_DIR, collection.name)
+    symbol_path = symbol_index_path(CHROMA_PERSIST_DIR, collection.name)
+    if new_collection:
+        lexical_index = LexicalIndex()
+        symbol_index = SymbolIndex()
+    else:
+        lexical_index = LexicalIndex.load(lexical_path)
+        symbol_index = SymbolIndex.load(symbol_path)
+    
+    for rel_path in removed:
+        release(rel_path, manifest["files"].pop(rel_path)["chunk_ids"])
+        symbol_index.remove_file(rel_path)
+    
+    # 読み込み → 分割 → 埋め込み → 保存 をバッチ単位で流す
+    print(f"{workers}個のワーカーでファイルを処理します")
+    progress.phase = "processing"
+    changed_by_path = {file_path: (rel_path, file_info) for file_path, rel_path, file_info in changed}
+    created_ids = set()
+    fresh_metadata = {}  # 今回処理したファイルで保存済みの内容と同じだったチャンクのメタデータ（共有されたチャンクのみ）
+    reused_count = 0
+    failed_paths = []
+    batch = _new_batch()
+    embedding_cache = EmbeddingCache(EMBEDDING_CACHE_DIR, EMBEDDING_MODEL_NAME)
+    try:
+        with BatchWriter(collection, embedding_cache) as writer:
+            for file_path, chunks in iter_processed_files(list(changed_by_path), workers, executor):
+                _check_cancelled(cancel_event)
+                rel_path, file_info = changed_by_path[file_path]
+                progress.files_processed += 1
+                progress.bytes_read += file_info["size"]
+                if chunks is None:
+                    # マニフェストを更新しないので、次回の増分更新で再試行される（前回のチャンクはそのまま残す）
+                    failed_paths.append(rel_path)
+                    continue
+                previous = manifest["files"].get(rel_path)
+                if previous:
+                    release(rel_path, previous["chunk_ids"])
+                
+                # 同じファイル内で同じ内容が繰り返される場合も1つにまとめる
+                chunk_ids = []
+                seen_ids = set()
+                definitions = []
+                for chunk in chunks:
+                    chunk_id = chunk_id_for(chunk.page_content)
+                    # 定義の位置はチャンクIDと一緒に記録し、同じ内容のチャンクでも定義のあるファイルごとに残す
+                    definitions.extend((name, line, chunk_id) for name, line in chunk.metadata.get("definitions", []))
+                    if chunk_id in seen_ids:
+                        continue
+                    seen_ids.add(chunk_id)
+                    chunk_ids.append(chunk_id)
+                    chunk_refs.setdefault(chunk_id, set()).add(rel_path)
+                    touched_ids.add(chunk_id)
+                    
+                    metadata = {
+                        "source": chunk.metadata.get("source", "Unknown"),
+                        "file_path": chunk.metadata.get("file_path", "Unknown"),
+                        "type": chunk.metadata.get("type", "code")
+                    }
+                    # コードのチャンクはシンボル名と行範囲、PDFのチャンクはページ番号も保存する
+                    for key in CHUNK_LOCATION_KEYS:
+                        if key in chunk.metadata:
+                            metadata[key] = chunk.metadata[key]
+                    
+                    # 保存済みの内容と同じチャンクは埋め込み・保存を省略する
+                    if chunk_id in stored_ids:
+                        reused_count += 1
+                        fresh_metadata.setdefault(chunk_id, metadata)
+                        continue
+                    metadata = dict(metadata, sources=rel_path)
+                    batch["ids"].append(chunk_id)
+                    batch["documents"].append(chunk.page_content)
+                    batch["metadatas"].append(metadata)
+                    stored_ids.add(chunk_id)
+                    created_ids.add(chunk_id)
+                    lexical_index.add(chunk_id, chunk.page_content)
+                    if len(batch["ids"]) >= INDEX_BATCH_SIZE:
+                        writer.put(batch)
+                        batch = _new_batch()
+                
+                file_info["chunk_ids"] = chunk_ids
+                manifest["files"][rel_path] = file_info
+                symbol_index.set_file(rel_path, definitions)
+                progress.chunks += len(chunk_ids)
+            
+            if batch["ids"]:
+                writer.put(batch)
+        
+        # ここから先はキャンセルせずに最後まで行うため、書き込んだチャンクを消せるうちに確認する
+        _check_cancelled(cancel_event)
+    except BaseException:
+        # 中断した場合は今回新しく書き込んだチャンクを消し、どのファイルからも参照されないチャンクを残さない
+        if created_ids:
+            try:
+                delete_chunks(collection, sorted(created_ids))
+            except Exception as e:
+                print(f"警告: 書き込み途中のチャンクを削除できませんでした: {e}")
+        raise
+    finally:
+        # 失敗した場合でも、計算済みの埋め込みは次回のために残す
+        embedding_cache.flush()
+        print(f"埋め込みキャッシュ: ヒット {embedding_cache.hits}件, ミス {embedding_cache.misses}件")
+    
+    print(f"合計{progress.chunks}チャンクを処理しました（新規 {len(created_ids)}件, 保存済みの内容と同じ {reused_count}件）")
+    if failed_paths:
+        print(f"警告: {len(failed_paths)}ファイルの処理に失敗しました。次回のインデックス作成で再試行します: {', '.join(failed_paths[:10])}"
+              + (" ..." if len(failed_paths) > 10 else ""))
+    
+    progress.phase = "finalizing"
+    
+    # どのファイルからも参照されなくなったチャンクをChromaDBから削除
+    stale_ids = sorted(chunk_id for chunk_id in touched_ids if not chunk_refs.get(chunk_id))
+    if stale_ids:
+        delete_chunks(collection, stale_ids)
+        for chunk_id in stale_ids:
+            lexical_index.remove(chunk_id)
+        print(f"ChromaDBから{len(stale_ids)}チャンクを削除しました")
+    
+    # 参照元のファイルが増減したチャンクのメタデータを更新
+    # （今回新しく書き込み、他のファイルから参照されなかったチャンクは書き込んだメタデータのままでよい）
+    shared_ids = sorted(
+        chunk_id for chunk_id in touched_ids
+        if chunk_refs.get(chunk_id) and (chunk_id not in created_ids or chunk_id in fresh_metadata)
+    )
+    updated_count = update_chunk_sources(collection, shared_ids, chunk_refs, fresh_metadata)
+    if updated_count:
+        print(f"{updated_count}チャンクの参照元ファイルを更新しました")
+    
+    lexical_index.save(lexical_path)
+    print(f"語彙インデックスを保存しました: {lexical_path}（{len(lexical_index)}チャンク）")
+    symbol_index.save(symbol_path)
+    print(f"シンボルインデックスを保存しました: {symbol_path}（{len(symbol_index)}定義）")
+    
+    save_manifest(manifest)
+    print(f"マニフェストを更新しました: {MANIFEST_PATH}")
+    
+    index_changed = bool(changed or removed) or alias is None or collection.name != alias["active"]
+    publish_collection(alias, collection.name, version, index_changed)
+    progress.phase = "completed"
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="ソースコードリポジトリのインデックスを作成します")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="マニフェストを無視して新しいコレクションにすべてのファイルを再インデックスする"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=INDEX_WORKERS,
+        help=f"ファイル処理の並列ワーカー数（デフォルト: {INDEX_WORKERS}、1で逐次処理）"
+    )
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    args = parse_args()
+    main(full_rebuild=args.full, workers=args.workers)
@@ -1,69 +1,626 @@
 import os
+import time
+import asyncio
+import threading
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
 import chromadb
 from chromadb.utils import embedding_functions
 from langchain_anthropic import ChatAnthropic
 from langchain.schema import Document
+from collection_alias import ALIAS_FILE_NAME, read_alias
+from context_builder import assemble_context
+from lexical_index import LexicalIndex, lexical_index_path, reciprocal_rank_fusion_scores, tokenize
+from symbol_index import SymbolIndex, symbol_index_path, find_identifiers
 
 # 設定
 CHROMA_HOST = "chroma"  # ChromaDBのホスト名
 CHROMA_PORT = 8000  # ChromaDBのポート
-COLLECTION_NAME = "code_chunks"  # コレクション名
+COLLECTION_NAME = "code_chunks"  # コレクション名（エイリアスがない場合に使用）
+CHROMA_PERSIST_DIR = "/app/chroma_db"  # ChromaDBの保存先
+ALIAS_PATH = os.path.join(CHROMA_PERSIST_DIR, ALIAS_FILE_NAME)  # 有効なコレクションを指すエイリアスファイル
 ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")  # 環境変数からAPIキーを取得
+HYBRID_CANDIDATES = 20  # ベクトル検索とBM25検索のそれぞれで統合前に取得する候補数
+RRF_K = 60  # Reciprocal Rank Fusion の定数（大きいほど下位の順位も効く）
+SYMBOL_PIN_LIMIT = 3  # 質問中の識別子の定義として検索結果の先頭に固定するチャンクの最大数
+SYMBOL_MAX_DEFINITIONS = 3  # 定義されているチャンクがこれより多い名前は曖昧とみなして固定しない
+MMR_FETCH_K = 20  # MMRで選び直す前に取得する統合後の候補数
+MMR_LAMBDA = 0.7  # MMRで関連度を重視する度合い（1.0で多様化しない、小さいほど似たチャンクを避ける）
+ANSWER_CACHE_SIZE = 256  # 回答キャッシュに保持する最大件数
+ANSWER_CACHE_TTL = 3600  # 回答キャッシュの有効期間（秒）
+ANSWER_CACHE_SIMILARITY = 0.95  # 意味的に同じ質問とみなすコサイン類似度の閾値
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"  # エンベディングモデル名
+LLM_MODEL_NAME = "claude-3-sonnet-20240229"  # LLMのモデル名
+WARMUP_INITIAL_DELAY = 1  # 初期化に失敗した場合の最初の再試行までの待ち時間（秒）
+WARMUP_MAX_DELAY = 30  # 再試行の待ち時間の上限（秒）
+BATCH_LLM_CONCURRENCY = 4  # 一括質問でLLMを同時に呼び出す最大数
+CONTEXT_TOKEN_BUDGET = 3000  # プロンプトに入れる参照コードのトークン数の上限（概算）
+SEARCH_HIGHLIGHT_LINES = 3  # 検索結果ごとに返すハイライト行の最大数
 
-# ChromaDBクライアントの初期化
-client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+# ChromaDBクライアント・エンベディングモデル・LLMは最初に使われたとき（通常は起動時の warmup）に初期化する
+_resources = {"chroma": None, "embedding_model": None, "llm": None}
+_resource_errors = {}
+_resource_locks = {name: threading.Lock() for name in _resources}
 
-# エンベディング関数の初期化
-embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
-    model_name="all-MiniLM-L6-v2"
-)
+def _get_resource(name, factory):
+    """リソースをスレッドセーフに一度だけ初期化して返す。失敗した場合は次の呼び出しで再試行する"""
+    resource = _resources[name]
+    if resource is not None:
+        return resource
+    with _resource_locks[name]:
+        if _resources[name] is None:
+            try:
+                _resources[name] = factory()
+            except Exception as e:
+                _resource_errors[name] = str(e)
+                raise
+            _resource_errors.pop(name, None)
+            print(f"{name} を初期化しました")
+        return _resources[name]
 
-# コレクションの取得
-try:
-    collection = client.get_collection(
-        name=COLLECTION_NAME,
-        embedding_function=embedding_function
+def get_client():
+    """ChromaDBクライアント"""
+    return _get_resource("chroma", lambda: chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT))
+
+def get_embedding_function():
+    """エンベディング関数（SentenceTransformerモデル）"""
+    return _get_resource(
+        "embedding_model",
+        lambda: embedding_functions.SentenceTransformerEmbeddingFunction(model_name=EMBEDDING_MODEL_NAME)
     )
-    print(f"コレクション '{COLLECTION_NAME}' を取得しました")
-except Exception as e:
-    print(f"コレクションの取得中にエラーが発生しました: {e}")
-    print("まず /index エンドポイントを呼び出してコードベースのインデックスを作成してください")
-    collection = None
-
-# LLMの初期化
-llm = ChatAnthropic(
-    model="claude-3-sonnet-20240229",
-    temperature=0,
-    anthropic_api_key=ANTHROPIC_API_KEY
-)
 
-def query_code(question, k=5):
-    """コードベースに対して質問を行い、回答と参照ソースを返す"""
+def get_llm():
+    """LLM"""
+    return _get_resource(
+        "llm",
+        lambda: ChatAnthropic(
+            model=LLM_MODEL_NAME,
+            temperature=0,
+            anthropic_api_key=ANTHROPIC_API_KEY
+        )
+    )
+
+# 有効なコレクションのハンドル（エイリアスファイルが更新されたときだけ取得し直す）
+_active_collection = {
+    "alias_mtime": None,
+    "name": None,
+    "index_version": 0,
+    "collection": None
+}
+_active_collection_lock = threading.Lock()
+
+def get_collection():
+    """有効なコレクションを返す。インデックスが作成されていない場合は None
+    
+    リクエストごとにエイリアスファイルの更新時刻だけを確認し、インデクサーが
+    新しいバージョンに切り替えた場合にのみハンドルを取得し直す。
+    """
+    try:
+        alias_mtime = os.stat(ALIAS_PATH).st_mtime_ns
+    except OSError:
+        alias_mtime = None
+    
+    with _active_collection_lock:
+        if _active_collection["collection"] is not None and _active_collection["alias_mtime"] == alias_mtime:
+            return _active_collection["collection"]
+        
+        alias = read_alias(ALIAS_PATH) if alias_mtime is not None else None
+        name = alias["active"] if alias else COLLECTION_NAME
+        try:
+            collection = get_client().get_collection(
+                name=name,
+                embedding_function=get_embedding_function()
+            )
+        except Exception as e:
+            print(f"コレクションの取得中にエラーが発生しました: {e}")
+            print("まず /index エンドポイントを呼び出してコードベースのインデックスを作成してください")
+            return None
+        
+        _active_collection.update({
+            "alias_mtime": alias_mtime,
+            "name": name,
+            "index_version": alias.get("index_version", 0) if alias else 0,
+            "collection": collection
+        })
+        print(f"コレクション '{name}' を取得しました")
+        return collection
+
+class CollectionFileIndex:
+    """有効なコレクションに付随するインデックスファイル（ファイルが更新されたときだけ読み込み直す）"""
+    
+    def __init__(self, label, unit, path_fn, load_fn):
+        self.label = label
+        self.unit = unit
+        self.path_fn = path_fn
+        self.load_fn = load_fn
+        self._lock = threading.Lock()
+        self._path = None
+        self._mtime = None
+        self._index = None
+    
+    def get(self):
+        """インデックスを返す。有効なコレクションがないか、ファイルがなければ None"""
+        if _active_collection["name"] is None:
+            return None
+        path = self.path_fn(CHROMA_PERSIST_DIR, _active_collection["name"])
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        
+        with self._lock:
+            if self._path != path or self._mtime != mtime:
+                self._path, self._mtime, self._index = path, mtime, self.load_fn(path)
+                print(f"{self.label}を読み込みました: {path}（{len(self._index)}{self.unit}）")
+            return self._index
+
+_lexical_index = CollectionFileIndex("語彙インデックス", "チャンク", lexical_index_path, LexicalIndex.load)
+_symbol_index = CollectionFileIndex("シンボルインデックス", "定義", symbol_index_path, SymbolIndex.load)
+
+def get_lexical_index():
+    """有効なコレクションに対応するBM25の語彙インデックスを返す。ファイルがなければ None"""
+    return _lexical_index.get()
+
+def get_symbol_index():
+    """有効なコレクションに対応するシンボルインデックスを返す。ファイルがなければ None"""
+    return _symbol_index.get()
+
+def find_definition_chunks(question, symbol_index, limit=SYMBOL_PIN_LIMIT):
+    """質問中の識別子が定義されているチャンクのIDを最大 limit 件返す
+    
+    定義されているチャンクが SYMBOL_MAX_DEFINITIONS 個より多い名前（__init__ など）は
+    特定できないので対象外にする。同じ内容のコピーは1つのチャンクにまとめられているので、
+    ファイルの数ではなくチャンクの数で数える。
+    """
+    chunk_ids = []
+    for identifier in find_identifiers(question):
+        definition_chunks = list(dict.fromkeys(chunk_id for _, _, _, chunk_id in symbol_index.lookup(identifier)))
+        if not definition_chunks or len(definition_chunks) > SYMBOL_MAX_DEFINITIONS:
+            continue
+        for chunk_id in definition_chunks:
+            if chunk_id not in chunk_ids:
+                chunk_ids.append(chunk_id)
+    return chunk_ids[:limit]
+
+def get_index_version():
+    """現在有効なインデックスのバージョン番号（再インデックスのたびに増える）"""
+    get_collection()
+    return _active_collection["index_version"]
+
+def warmup():
+    """起動時にすべてのリソースを初期化する
+    
+    ChromaDBがまだ起動していない場合などは、すべて初期化できるまで指数バックオフで
+    再試行し続ける。バックグラウンドのスレッドから呼び出すこと。
+    """
+    delay = WARMUP_INITIAL_DELAY
+    while True:
+        pending = []
+        for name, getter in (("chroma", get_client), ("embedding_model", get_embedding_function), ("llm", get_llm)):
+            try:
+                getter()
+            except Exception as e:
+                pending.append(name)
+                print(f"警告: {name} を初期化できませんでした: {e}")
+        if not pending:
+            break
+        print(f"{delay}秒後に {', '.join(pending)} の初期化を再試行します")
+        time.sleep(delay)
+        delay = min(delay * 2, WARMUP_MAX_DELAY)
+    
+    # モデルの遅延初期化分も含めて最初の質問の前に済ませておく
+    get_embedding_function()(["warmup"])
+    get_collection()
+    print("クエリ用のリソースの初期化が完了しました")
+
+def readiness():
+    """各リソースの初期化状態を返す"""
+    status = {name: _resources[name] is not None for name in _resources}
+    status["collection"] = _active_collection["collection"] is not None
+    status["ready"] = all(_resources[name] is not None for name in _resources)
+    status["errors"] = dict(_resource_errors)
+    return status
+
+NO_INDEX_RESULT = "エラー: コレクションが初期化されていません。まず /index エンドポイントを呼び出してください。"
+
+def normalize_question(question):
+    """全角・半角、大文字・小文字、空白の違いを吸収した質問文を返す"""
+    return " ".join(unicodedata.normalize("NFKC", question).lower().split())
+
+def embed_questions(questions):
+    """複数の質問を1回のモデル呼び出しで正規化済み（長さ1）の埋め込み行列に変換"""
+    embeddings = np.asarray(get_embedding_function()(list(questions)), dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.where(norms > 0, norms, 1.0)
+
+def embed_question(question):
+    """質問を正規化済み（長さ1）の埋め込みベクトルに変換"""
+    return embed_questions([question])[0]
+
+class AnswerCache:
+    """質問に対する回答のキャッシュ
+    
+    正規化した質問文の完全一致で引く層と、質問の埋め込みのコサイン類似度が閾値以上の
+    エントリを再利用する意味的な層の2段構成。エントリはインデックスバージョンに紐づき、
+    再インデックスされると破棄される。件数はLRUで、期間はTTLで制限する。
+    """
+    
+    def __init__(self, max_entries=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, similarity_threshold=ANSWER_CACHE_SIMILARITY):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (k, 正規化した質問) -> エントリ
+        self._index_version = None
+        self._matrix = None  # 意味的な層で使う埋め込みの行列（エントリが変わったら作り直す）
+        self._matrix_keys = []
+        self._lock = threading.Lock()
+    
+    def _sync(self, index_version):
+        """インデックスバージョンが変わっていればすべて破棄し、期限切れのエントリを削除する"""
+        if index_version != self._index_version:
+            self._entries.clear()
+            self._matrix = None
+            self._index_version = index_version
+        now = time.time()
+        expired = [key for key, entry in self._entries.items() if entry["expires_at"] <= now]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+    
+    def get_exact(self, question_key, k, index_version):
+        with self._lock:
+            self._sync(index_version)
+            entry = self._entries.get((k, question_key))
+            if entry is None:
+                return None
+            self._entries.move_to_end((k, question_key))
+            self.exact_hits += 1
+            return dict(entry["result"])
+    
+    def get_similar(self, embedding, k, index_version):
+        with self._lock:
+            self._sync(index_version)
+            if not self._entries:
+                self.misses += 1
+                return None
+            if self._matrix is None:
+                self._matrix_keys = list(self._entries)
+                self._matrix = np.vstack([self._entries[key]["embedding"] for key in self._matrix_keys])
+            
+            # 埋め込みは正規化済みなので内積がコサイン類似度になる
+            similarities = self._matrix @ embedding
+            for position in np.argsort(-similarities):
+                if similarities[position] < self.similarity_threshold:
+                    break
+                key = self._matrix_keys[position]
+                if key[0] == k:
+                    self._entries.move_to_end(key)
+                    self.semantic_hits += 1
+                    return dict(self._entries[key]["result"])
+            self.misses += 1
+            return None
+    
+    def put(self, cache_key, result):
+        with self._lock:
+            if cache_key["index_version"] != self._index_version:
+                return
+            key = (cache_key["k"], cache_key["question"])
+            self._entries[key] = {
+                "embedding": cache_key["embedding"],
+                "result": result,
+                "expires_at": time.time() + self.ttl
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+    
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "index_version": self._index_version,
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses
+            }
+
+answer_cache = AnswerCache()
+
+class StageTimings:
+    """検索・回答の段階ごとの所要時間を集計する"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = OrderedDict()
+    
+    def record(self, stage, seconds):
+        with self._lock:
+            entry = self._stages.setdefault(stage, {"count": 0, "total": 0.0, "max": 0.0, "last": 0.0})
+            entry["count"] += 1
+            entry["total"] += seconds
+            entry["max"] = max(entry["max"], seconds)
+            entry["last"] = seconds
+    
+    @contextmanager
+    def measure(self, stage):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started_at)
+    
+    def stats(self):
+        with self._lock:
+            return {
+                stage: {
+                    "count": entry["count"],
+                    "avg_ms": round(entry["total"] / entry["count"] * 1000, 2),
+                    "max_ms": round(entry["max"] * 1000, 2),
+                    "last_ms": round(entry["last"] * 1000, 2)
+                }
+                for stage, entry in self._stages.items()
+            }
+
+stage_timings = StageTimings()
+
+def mmr_select(relevance, embeddings, k, lambda_mult=MMR_LAMBDA):
+    """Maximal Marginal Relevance で関連度が高く互いに似ていない候補を k 件選び、その位置を返す
+    
+    relevance は候補ごとの関連度（0〜1）、embeddings は正規化済みの埋め込み行列（候補数 x 次元）。
+    候補同士の類似度は1回の行列積で求め、選ぶたびに「選択済みとの最大類似度」だけを更新する。
+    """
+    count = len(relevance)
+    if k <= 0:
+        return []
+    if count <= k or lambda_mult >= 1.0:
+        return list(np.argsort(-relevance, kind="stable")[:k])
+    similarity = embeddings @ embeddings.T
+    
+    selected = [int(np.argmax(relevance))]
+    max_similarity = similarity[selected[0]].copy()
+    available = np.ones(count, dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < k:
+        scores = lambda_mult * relevance - (1.0 - lambda_mult) * max_similarity
+        scores[~available] = -np.inf
+        chosen = int(np.argmax(scores))
+        selected.append(chosen)
+        available[chosen] = False
+        np.maximum(max_similarity, similarity[chosen], out=max_similarity)
+    return selected
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+def retrieve_documents(question, k=5, query_embedding=None):
+    """ベクトル検索とBM25検索の結果を統合して類似ドキュメントを検索する。コレクションがない場合は None
+    
+    それぞれ HYBRID_CANDIDATES 件の候補を取得し、Reciprocal Rank Fusion で順位を統合する。
+    識別子の完全一致に強いBM25を併用することで、小さな k でも必要なチャンクが入りやすくなる。
+    語彙インデックスがない場合はベクトル検索のみを行う。統合した上位 MMR_FETCH_K 件から
+    MMR で似たチャンクが重ならないように k 件を選ぶ。質問に識別子が含まれていれば、
+    シンボルインデックスで引いたその定義のチャンクを先頭に固定する。
+    """
+    query_embeddings = None if query_embedding is None else [query_embedding]
+    results = retrieve_documents_batch([question], k, query_embeddings)
+    return None if results is None else results[0]
+
+def retrieve_documents_batch(questions, k=5, query_embeddings=None):
+    """複数の質問の類似ドキュメントをまとめて検索する。コレクションがない場合は None
+    
+    質問のベクトル化は1回のモデル呼び出し、ベクトル検索は1回の複数クエリで行い、
+    BM25だけで見つかったチャンクの本文と埋め込みもまとめて取得する。
+    各段階の所要時間は stage_timings に記録する。
+    """
+    collection = get_collection()
     if collection is None:
-        return {
-            "result": "エラー: コレクションが初期化されていません。まず /index エンドポイントを呼び出してください。",
-            "source_documents": []
-        }
+        return None
+    if not questions:
+        return []
+    fetch_k = max(k, MMR_FETCH_K)
+    candidate_count = max(fetch_k, HYBRID_CANDIDATES)
     
-    # 質問をベクトル化して類似ドキュメントを検索
-    results = collection.query(
-        query_texts=[question],
-        n_results=k
-    )
+    # 埋め込み済みの場合はそれを使い、質問を二重にベクトル化しない
+    if query_embeddings is None:
+        with stage_timings.measure("embed"):
+            query_embeddings = embed_questions(questions)
+    with stage_timings.measure("vector_search"):
+        results = collection.query(
+            query_embeddings=[np.asarray(embedding).tolist() for embedding in query_embeddings],
+            n_results=candidate_count,
+            include=["documents", "metadatas", "embeddings"]
+        )
+    
+    found = {}
+    embeddings = {}
+    fused_lists = []
+    lexical_index = get_lexical_index()
+    with stage_timings.measure("lexical_search"):
+        for position, question in enumerate(questions):
+            vector_ids = results["ids"][position]
+            found.update(zip(vector_ids, zip(results["documents"][position], results["metadatas"][position])))
+            embeddings.update(zip(vector_ids, results["embeddings"][position]))
+            if lexical_index is not None and len(lexical_index) > 0:
+                lexical_ids = [chunk_id for chunk_id, _ in lexical_index.search(question, candidate_count)]
+                fused_lists.append(reciprocal_rank_fusion_scores([vector_ids, lexical_ids], RRF_K)[:fetch_k])
+            else:
+                fused_lists.append([(chunk_id, 1.0 / (RRF_K + rank + 1)) for rank, chunk_id in enumerate(vector_ids[:fetch_k])])
+    
+    # 識別子の定義はベクトル検索の結果によらず必ず含める
+    symbol_index = get_symbol_index()
+    with stage_timings.measure("symbol_lookup"):
+        pinned_lists = [
+            find_definition_chunks(question, symbol_index, min(k, SYMBOL_PIN_LIMIT)) if symbol_index is not None else []
+            for question in questions
+        ]
     
-    # 検索結果からドキュメントを作成
+    # BM25だけで見つかったチャンクと固定するチャンクの本文と埋め込みを取得
+    candidate_ids = {chunk_id for fused in fused_lists for chunk_id, _ in fused}
+    candidate_ids.update(chunk_id for pinned in pinned_lists for chunk_id in pinned)
+    missing_ids = sorted(chunk_id for chunk_id in candidate_ids if chunk_id not in found)
+    if missing_ids:
+        with stage_timings.measure("fetch"):
+            fetched = collection.get(ids=missing_ids, include=["documents", "metadatas", "embeddings"])
+        found.update(zip(fetched["ids"], zip(fetched["documents"], fetched["metadatas"])))
+        embeddings.update(zip(fetched["ids"], fetched["embeddings"]))
+    
+    # 統合スコアを関連度、埋め込みのコサイン類似度を候補同士の近さとしてMMRで選び直す
+    ranked_lists = []
+    with stage_timings.measure("rerank"):
+        for fused, pinned in zip(fused_lists, pinned_lists):
+            pinned = [chunk_id for chunk_id in pinned if chunk_id in found]
+            fused = [(chunk_id, score) for chunk_id, score in fused if chunk_id in found and chunk_id not in pinned]
+            if not fused:
+                ranked_lists.append(pinned)
+                continue
+            candidate_ids = [chunk_id for chunk_id, _ in fused]
+            relevance = np.array([score for _, score in fused])
+            relevance = relevance / relevance.max()
+            matrix = _normalize_rows(np.array([embeddings[chunk_id] for chunk_id in candidate_ids], dtype=np.float32))
+            ranked_lists.append(pinned + [candidate_ids[i] for i in mmr_select(relevance, matrix, k - len(pinned))])
+    
+    return [build_documents(ranked_ids, found) for ranked_ids in ranked_lists]
+
+def build_documents(ranked_ids, found):
+    """検索結果（チャンクID -> (本文, メタデータ)）から順位どおりにドキュメントを作成"""
     source_documents = []
-    for i in range(len(results["documents"][0])):
+    for chunk_id in ranked_ids:
+        if chunk_id not in found:
+            continue
+        content, metadata = found[chunk_id]
         doc = Document(
-            page_content=results["documents"][0][i],
+            page_content=content,
             metadata={
-                "source": results["metadatas"][0][i]["source"],
-                "file_path": results["metadatas"][0][i]["file_path"]
+                "source": metadata["source"],
+                "file_path": metadata["file_path"]
             }
         )
+        # コードのチャンクにはシンボル名と行範囲、PDFのチャンクにはページ番号がある
+        for key in ("symbol", "start_line", "end_line", "page"):
+            if key in metadata:
+                doc.metadata[key] = metadata[key]
+        # 同じ内容のチャンクは1つにまとめて保存されているので、含んでいるすべてのファイルに展開する
+        doc.metadata["sources"] = metadata["sources"].split("\n") if metadata.get("sources") else [metadata["source"]]
         source_documents.append(doc)
+    return source_documents
+
+def highlight_lines(text, start_line, terms, max_lines=SEARCH_HIGHLIGHT_LINES):
+    """検索語を含む行と、行内で一致した位置を返す
+    
+    多くの検索語を含む行から最大 max_lines 行を選び、行番号順に
+    {"line": 行番号, "text": 行, "matches": [[開始, 終了], ...]} のリストで返す。
+    """
+    candidates = []
+    for offset, line in enumerate(text.split("\n")):
+        lower = line.lower()
+        spans = []
+        matched_terms = 0
+        for term in terms:
+            position = lower.find(term)
+            if position == -1:
+                continue
+            matched_terms += 1
+            while position != -1:
+                spans.append([position, position + len(term)])
+                position = lower.find(term, position + len(term))
+        if not spans:
+            continue
+        # 重なっている一致をまとめる
+        spans.sort()
+        merged = [spans[0]]
+        for span in spans[1:]:
+            if span[0] <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], span[1])
+            else:
+                merged.append(span)
+        candidates.append((matched_terms, offset, line, merged))
+    
+    best = sorted(candidates, key=lambda item: (-item[0], item[1]))[:max_lines]
+    return [
+        {"line": start_line + offset, "text": line, "matches": spans}
+        for _, offset, line, spans in sorted(best, key=lambda item: item[1])
+    ]
+
+def search_code(query, limit=10, offset=0):
+    """LLMを使わずに、質問に関連するチャンクをスコア付きで返す。コレクションがない場合は None
+    
+    /query と同じハイブリッド検索（ベクトル検索 + BM25 を RRF で統合）の結果から
+    offset 件目以降の limit 件を返す。各結果には統合スコアに加えてベクトル距離と
+    BM25スコア（それぞれの候補に入った場合）、行範囲、検索語のハイライトを含める。
+    """
+    collection = get_collection()
+    if collection is None:
+        return None
+    candidate_count = max(offset + limit + 1, HYBRID_CANDIDATES)
+    
+    results = collection.query(
+        query_embeddings=[embed_question(query).tolist()],
+        n_results=candidate_count,
+        include=["documents", "metadatas", "distances"]
+    )
+    vector_ids = results["ids"][0]
+    distances = dict(zip(vector_ids, results["distances"][0]))
+    found = dict(zip(vector_ids, zip(results["documents"][0], results["metadatas"][0])))
+    
+    lexical_index = get_lexical_index()
+    bm25_scores = {}
+    if lexical_index is not None and len(lexical_index) > 0:
+        bm25_scores = dict(lexical_index.search(query, candidate_count))
+    ranked = reciprocal_rank_fusion_scores([vector_ids, list(bm25_scores)], RRF_K)
+    page = ranked[offset:offset + limit]
     
-    # プロンプトの作成
+    # BM25だけで見つかったチャンクの本文を取得
+    missing_ids = [chunk_id for chunk_id, _ in page if chunk_id not in found]
+    if missing_ids:
+        fetched = collection.get(ids=missing_ids, include=["documents", "metadatas"])
+        found.update(zip(fetched["ids"], zip(fetched["documents"], fetched["metadatas"])))
+    
+    terms = sorted(set(tokenize(query)), key=len, reverse=True)
+    hits = []
+    for chunk_id, score in page:
+        if chunk_id not in found:
+            continue
+        doc = build_documents([chunk_id], found)[0]
+        hit = {
+            "id": chunk_id,
+            "score": score,
+            "vector_distance": distances.get(chunk_id),
+            "bm25_score": bm25_scores.get(chunk_id),
+            "file": doc.metadata["source"],
+            "files": doc.metadata["sources"],
+            "location": describe_location(doc),
+            "highlights": highlight_lines(doc.page_content, doc.metadata.get("start_line", 1), terms),
+            "snippet": doc.page_content[:200]
+        }
+        for key in ("symbol", "start_line", "end_line", "page"):
+            if key in doc.metadata:
+                hit[key] = doc.metadata[key]
+        hits.append(hit)
+    return {"results": hits, "has_more": len(ranked) > offset + limit}
+
+def describe_location(doc):
+    """ファイル名に行範囲とシンボル名、またはページ番号を添えた表記（例: app.py:10-42 main、spec.pdf p.12）"""
+    location = doc.metadata["source"]
+    if "start_line" in doc.metadata:
+        location += f":{doc.metadata['start_line']}-{doc.metadata['end_line']}"
+    if "page" in doc.metadata:
+        location += f" p.{doc.metadata['page']}"
+    if doc.metadata.get("symbol"):
+        # 小さな定義をまとめたチャンクはシンボルが多いので先頭の数件だけ示す
+        symbols = doc.metadata["symbol"].split(", ")
+        location += " " + ", ".join(symbols[:3]) + (" ..." if len(symbols) > 3 else "")
+    return location
+
+def build_prompt(question, source_documents):
+    """検索したスニペットからLLMへのプロンプトを作成"""
     prompt = f"""
 あなたはコードベースに関する質問に答えるアシスタントです。
 以下のコードスニペットを参照して、質問に答えてください。
@@ -74,29 +631,259 @@ def query_code(question, k=5):
 """
     
     for i, doc in enumerate(source_documents):
-        prompt += f"\n--- スニペット {i+1} (ファイル: {doc.metadata['source']}) ---\n"
+        prompt += f"\n--- スニペット {i+1} (ファイル: {describe_location(doc)}) ---\n"
+        other_sources = [source for source in doc.metadata.get("sources", []) if source != doc.metadata["source"]]
+        if other_sources:
+            prompt += f"（同じ内容: {', '.join(other_sources)}）\n"
+        if doc.metadata.get("truncated"):
+            prompt += "（長いため途中まで）\n"
         prompt += doc.page_content + "\n"
     
     prompt += "\n上記のコードスニペットに基づいて、質問に対する回答を日本語で提供してください。"
-    
-    # LLMに質問を送信
-    response = llm.invoke(prompt)
-    
-    # 結果を表示
+    return prompt
+
+def print_result(question, answer, source_documents):
+    """結果を表示"""
     print("\n質問:")
     print(question)
     print("\n回答:")
-    print(response.content)
+    print(answer)
     print("\n参照ソース:")
     for i, doc in enumerate(source_documents):
         print(f"\nソース {i+1}:")
-        print(f"ファイル: {doc.metadata.get('source', 'Unknown')}")
+        print(f"ファイル: {', '.join(doc.metadata.get('sources', [doc.metadata.get('source', 'Unknown')]))}")
         print(f"内容: {doc.page_content[:200]}...")
+
+def prepare_query(question, k=5):
+    """回答キャッシュを確認し、ヒットしなければ類似ドキュメントを検索する
+    
+    戻り値は (キャッシュされた結果, 参照ドキュメント, キャッシュ登録用のキー)。
+    結果が確定している場合（キャッシュヒット、インデックスなし）は参照ドキュメントが None になる。
+    """
+    if get_collection() is None:
+        return {"result": NO_INDEX_RESULT, "source_documents": []}, None, None
+    index_version = get_index_version()
+    
+    # 完全一致であれば質問のベクトル化も不要
+    question_key = normalize_question(question)
+    cached = answer_cache.get_exact(question_key, k, index_version)
+    if cached is not None:
+        return cached, None, None
+    
+    with stage_timings.measure("embed"):
+        query_embedding = embed_question(question)
+    cached = answer_cache.get_similar(query_embedding, k, index_version)
+    if cached is not None:
+        return cached, None, None
+    
+    source_documents = retrieve_documents(question, k, query_embedding)
+    if source_documents is None:
+        return {"result": NO_INDEX_RESULT, "source_documents": []}, None, None
+    # 重なっているチャンクを結合し、重複を除いてトークン予算に収める
+    with stage_timings.measure("assemble"):
+        source_documents = assemble_context(source_documents, CONTEXT_TOKEN_BUDGET)
+    cache_key = {
+        "question": question_key,
+        "embedding": query_embedding,
+        "k": k,
+        "index_version": index_version
+    }
+    return None, source_documents, cache_key
+
+def prepare_query_batch(questions, k=5):
+    """prepare_query の一括版。キャッシュにない質問だけをまとめてベクトル化・検索する
+    
+    戻り値は質問ごとの (キャッシュされた結果, 参照ドキュメント, キャッシュ登録用のキー) のリスト。
+    """
+    if get_collection() is None:
+        return [({"result": NO_INDEX_RESULT, "source_documents": []}, None, None) for _ in questions]
+    index_version = get_index_version()
+    prepared = [None] * len(questions)
+    
+    # 完全一致であれば質問のベクトル化も不要
+    question_keys = [normalize_question(question) for question in questions]
+    pending = []
+    for position, question_key in enumerate(question_keys):
+        cached = answer_cache.get_exact(question_key, k, index_version)
+        if cached is not None:
+            prepared[position] = (cached, None, None)
+        else:
+            pending.append(position)
+    if not pending:
+        return prepared
+    
+    with stage_timings.measure("embed"):
+        embeddings = embed_questions([questions[position] for position in pending])
+    to_search = []
+    for position, embedding in zip(pending, embeddings):
+        cached = answer_cache.get_similar(embedding, k, index_version)
+        if cached is not None:
+            prepared[position] = (cached, None, None)
+        else:
+            to_search.append((position, embedding))
+    if not to_search:
+        return prepared
+    
+    results = retrieve_documents_batch(
+        [questions[position] for position, _ in to_search],
+        k,
+        [embedding for _, embedding in to_search]
+    )
+    for (position, embedding), source_documents in zip(to_search, results or [None] * len(to_search)):
+        if source_documents is None:
+            prepared[position] = ({"result": NO_INDEX_RESULT, "source_documents": []}, None, None)
+            continue
+        with stage_timings.measure("assemble"):
+            source_documents = assemble_context(source_documents, CONTEXT_TOKEN_BUDGET)
+        cache_key = {
+            "question": question_keys[position],
+            "embedding": embedding,
+            "k": k,
+            "index_version": index_version
+        }
+        prepared[position] = (None, source_documents, cache_key)
+    return prepared
+
+def query_code(question, k=5):
+    """コードベースに対して質問を行い、回答と参照ソースを返す"""
+    cached, source_documents, cache_key = prepare_query(question, k)
+    if cached is not None:
+        return cached
+    
+    # LLMに質問を送信
+    with stage_timings.measure("llm"):
+        response = get_llm().invoke(build_prompt(question, source_documents))
+    print_result(question, response.content, source_documents)
     
-    return {
+    result = {
         "result": response.content,
         "source_documents": source_documents
     }
+    answer_cache.put(cache_key, result)
+    return result
+
+# 処理中の質問（(正規化した質問, k, インデックスバージョン) -> asyncio.Task）
+_inflight_queries = {}
+single_flight_stats = {"started": 0, "coalesced": 0}
+
+class _Unlimited:
+    """limiter を指定しない場合に使う、何もしない非同期コンテキストマネージャー"""
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+async def aquery_code(question, k=5, limiter=None):
+    """query_code の非同期版。イベントループをブロックしない
+    
+    同じ質問（正規化後）が同じインデックスバージョンに対して同時に処理中であれば、
+    新しく検索・LLM呼び出しを行わずにその結果を共有する。
+    limiter（非同期コンテキストマネージャー）を指定すると、実際に検索・LLM呼び出しを行う間だけそれを取得する
+    （結果を共有して待つだけの呼び出しは取得しない）。
+    """
+    index_version = await asyncio.to_thread(get_index_version)
+    key = (normalize_question(question), k, index_version)
+    
+    async def run():
+        async with limiter or _Unlimited():
+            return await _aquery_code(question, k)
+    
+    task = _inflight_queries.get(key)
+    if task is None:
+        task = asyncio.ensure_future(run())
+        _inflight_queries[key] = task
+        task.add_done_callback(lambda _: _inflight_queries.pop(key, None))
+        single_flight_stats["started"] += 1
+    else:
+        single_flight_stats["coalesced"] += 1
+    
+    # 1人のクライアントが切断しても、共有している処理はキャンセルしない
+    result = await asyncio.shield(task)
+    return dict(result)
+
+async def _aquery_code(question, k=5):
+    """検索とLLM呼び出しを行う。ChromaDBのクライアントは同期APIのみのため、
+    検索はスレッドにオフロードし、LLMの呼び出しは非同期APIで待つ
+    """
+    cached, source_documents, cache_key = await asyncio.to_thread(prepare_query, question, k)
+    if cached is not None:
+        return cached
+    
+    with stage_timings.measure("llm"):
+        response = await get_llm().ainvoke(build_prompt(question, source_documents))
+    print_result(question, response.content, source_documents)
+    
+    result = {
+        "result": response.content,
+        "source_documents": source_documents
+    }
+    answer_cache.put(cache_key, result)
+    return result
+
+async def aquery_code_batch(questions, k=5, concurrency=BATCH_LLM_CONCURRENCY, limiter=None):
+    """複数の質問にまとめて回答する
+    
+    ベクトル化と検索は prepare_query_batch で一括して行い、LLMの呼び出しは最大 concurrency 件ずつ
+    並行して行う。同じ質問（正規化後）が複数含まれる場合は1回だけ処理する。
+    limiter（非同期コンテキストマネージャー）を指定すると、検索全体とLLMの呼び出し1回ごとにそれを取得する。
+    結果は質問と同じ順序のリストで、失敗した質問は {"error": メッセージ} になる。
+    """
+    limiter = limiter or _Unlimited()
+    unique_questions = list(OrderedDict((normalize_question(question), question) for question in questions).values())
+    async with limiter:
+        prepared = await asyncio.to_thread(prepare_query_batch, unique_questions, k)
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def answer(question, cached, source_documents, cache_key):
+        if cached is not None:
+            return cached
+        async with semaphore, limiter:
+            with stage_timings.measure("llm"):
+                response = await get_llm().ainvoke(build_prompt(question, source_documents))
+        result = {
+            "result": response.content,
+            "source_documents": source_documents
+        }
+        answer_cache.put(cache_key, result)
+        return result
+    
+    answers = await asyncio.gather(
+        *(answer(question, *entry) for question, entry in zip(unique_questions, prepared)),
+        return_exceptions=True
+    )
+    by_key = {}
+    for question, result in zip(unique_questions, answers):
+        by_key[normalize_question(question)] = {"error": str(result)} if isinstance(result, Exception) else result
+    return [dict(by_key[normalize_question(question)]) for question in questions]
+
+def query_code_batch(questions, k=5, concurrency=BATCH_LLM_CONCURRENCY):
+    """aquery_code_batch の同期版"""
+    return asyncio.run(aquery_code_batch(questions, k, concurrency))
+
+async def astream_query(question, k=5):
+    """質問に対する回答をストリーミングする非同期ジェネレーター
+    
+    まず ("sources", 参照ドキュメントのリスト) を返し、その後LLMが生成した順に
+    ("token", テキスト) を返す。検索が終わった時点で参照ソースを表示できる。
+    """
+    cached, source_documents, cache_key = await asyncio.to_thread(prepare_query, question, k)
+    if cached is not None:
+        yield "sources", cached["source_documents"]
+        yield "token", cached["result"]
+        return
+    
+    yield "sources", source_documents
+    
+    answer_parts = []
+    async for chunk in get_llm().astream(build_prompt(question, source_documents)):
+        if chunk.content:
+            answer_parts.append(chunk.content)
+            yield "token", chunk.content
+    answer = "".join(answer_parts)
+    print_result(question, answer, source_documents)
+    answer_cache.put(cache_key, {"result": answer, "source_documents": source_documents})
 
 if __name__ == "__main__":
     # ユーザーからの質問を受け付ける
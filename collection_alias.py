@@ -0,0 +1,69 @@
+import os
+import json
+import time
+
+# 設定
+ALIAS_FILE_NAME = "active_collection.json"  # 有効なコレクションを指すエイリアスファイル名
+
+def versioned_name(base_name, version):
+    """バージョン付きのコレクション名を返す（例: code_chunks_v3）"""
+    return f"{base_name}_v{version}"
+
+def read_alias(path):
+    """エイリアスファイルを読み込む。存在しない、または壊れている場合は None
+
+    形式:
+        active: 有効なコレクション名
+        version: 有効なコレクションのバージョン番号
+        index_version: インデックスが更新されるたびに増える番号（増分更新を含む）
+        retired: 切り替え済みの古いコレクション [{"name", "retired_at"}]
+        updated_at: 最終更新時刻
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            alias = json.load(f)
+        if isinstance(alias.get("active"), str):
+            return alias
+        print(f"警告: エイリアスファイルの形式が不正です: {path}")
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        print(f"警告: エイリアスファイルを読み込めませんでした: {e}")
+    return None
+
+def write_alias(path, alias):
+    """エイリアスファイルをアトミックに書き換える（読み手は常に新旧どちらかの完全な内容を見る）"""
+    alias["updated_at"] = time.time()
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(alias, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def next_alias(alias, collection_name, version, index_changed=True):
+    """collection_name を有効にしたエイリアスを返す。それまで有効だったコレクションは退役扱いにする
+
+    index_changed が False（増分更新で変更がなかった場合）は index_version を据え置き、
+    インデックスバージョンに紐づくキャッシュを無駄に無効化しない。
+    """
+    previous_active = alias["active"] if alias else None
+    retired = list(alias.get("retired", [])) if alias else []
+    if previous_active and previous_active != collection_name:
+        retired.append({"name": previous_active, "retired_at": time.time()})
+    return {
+        "active": collection_name,
+        "version": version,
+        "index_version": (alias.get("index_version", 0) if alias else 0) + (1 if index_changed else 0),
+        "retired": [entry for entry in retired if entry["name"] != collection_name]
+    }
+
+def expired_collections(alias, grace_period, now=None):
+    """猶予期間を過ぎた退役コレクションを (削除対象の名前リスト, 残すエントリ) に分ける"""
+    now = time.time() if now is None else now
+    expired = []
+    remaining = []
+    for entry in alias.get("retired", []):
+        if entry["retired_at"] + grace_period <= now:
+            expired.append(entry["name"])
+        else:
+            remaining.append(entry)
+    return expired, remaining
@@ -0,0 +1,201 @@
+import math
+import re
+from langchain.schema import Document
+
+# 設定
+NEAR_DUPLICATE_THRESHOLD = 0.8  # 単語シングルのうち上位の範囲にも含まれる割合がこれ以上なら重複とみなして除く
+SHINGLE_SIZE = 3  # 重複判定に使う単語シングルの長さ
+MIN_TEXT_OVERLAP = 20  # 行範囲のないチャンク同士をつなげるのに必要な重なりの最小文字数
+MIN_TRUNCATED_TOKENS = 200  # 予算の残りがこれ以上あれば、収まらないスパンを切り詰めて入れる
+SNIPPET_OVERHEAD_TOKENS = 20  # スニペットごとの見出し行などに見込むトークン数
+
+_WORD_PATTERN = re.compile(r"\S+")
+
+def estimate_tokens(text):
+    """トークン数の概算（ASCII は4文字で1トークン、それ以外は1文字で1トークンとみなす）"""
+    ascii_count = len(text.encode("ascii", errors="ignore"))
+    return math.ceil(ascii_count / 4) + (len(text) - ascii_count)
+
+def _split_lines(text):
+    """改行文字 (\n) だけで行に分ける（チャンク分割時の行番号と一致させる）"""
+    lines = text.split("\n")
+    if lines and lines[-1] == "":
+        lines.pop()
+    return lines
+
+class Span:
+    """同じファイルの連続した範囲。元になったチャンクのうち最も高い順位をスコアとして持つ"""
+
+    def __init__(self, rank, doc):
+        self.rank = rank
+        self.source = doc.metadata["source"]
+        self.file_path = doc.metadata["file_path"]
+        self.page = doc.metadata.get("page")
+        self.sources = list(doc.metadata.get("sources", [self.source]))
+        self.symbols = [symbol for symbol in (doc.metadata.get("symbol") or "").split(", ") if symbol]
+        self.chunk_count = 1
+        self.truncated = False
+        if "start_line" in doc.metadata:
+            self.start_line = doc.metadata["start_line"]
+            self.lines = _split_lines(doc.page_content)
+            self.text = None
+        else:
+            self.start_line = None
+            self.lines = None
+            self.text = doc.page_content
+
+    @property
+    def end_line(self):
+        return self.start_line + len(self.lines) - 1
+
+    @property
+    def content(self):
+        return "\n".join(self.lines) + "\n" if self.lines is not None else self.text
+
+    def _absorb(self, other):
+        self.rank = min(self.rank, other.rank)
+        # 一部だけが別のファイルと同じ内容の場合もあるので、すべてのチャンクに共通するファイルだけを残す
+        self.sources = [source for source in self.sources if source in other.sources]
+        for symbol in other.symbols:
+            if symbol not in self.symbols:
+                self.symbols.append(symbol)
+        self.chunk_count += other.chunk_count
+
+    def try_merge(self, other):
+        """重なっているか隣接していれば other を取り込んで True を返す"""
+        if other.source != self.source or other.page != self.page:
+            return False
+
+        if self.lines is not None and other.lines is not None:
+            if other.start_line > self.end_line + 1 or self.start_line > other.end_line + 1:
+                return False
+            merged = {}
+            for span in (other, self):
+                for offset, line in enumerate(span.lines):
+                    merged[span.start_line + offset] = line
+            start_line = min(self.start_line, other.start_line)
+            end_line = max(self.end_line, other.end_line)
+            self.lines = [merged[line_no] for line_no in range(start_line, end_line + 1)]
+            self.start_line = start_line
+            self._absorb(other)
+            return True
+
+        if self.text is not None and other.text is not None:
+            for first, second in ((self.text, other.text), (other.text, self.text)):
+                overlap = _text_overlap(first, second)
+                if overlap:
+                    self.text = first + second[overlap:]
+                    self._absorb(other)
+                    return True
+            if other.text in self.text:
+                self._absorb(other)
+                return True
+        return False
+
+    def truncate(self, max_tokens):
+        """先頭から max_tokens に収まるところまで残す（コードは行単位）"""
+        self.truncated = True
+        if self.lines is not None:
+            kept = []
+            used = 0
+            for line in self.lines:
+                used += estimate_tokens(line) + 1
+                if used > max_tokens and kept:
+                    break
+                kept.append(line)
+            self.lines = kept
+        else:
+            kept = self.text[:max_tokens]
+            while kept and estimate_tokens(kept) > max_tokens:
+                kept = kept[:int(len(kept) * 0.9)]
+            self.text = kept
+
+    def to_document(self):
+        metadata = {
+            "source": self.source,
+            "file_path": self.file_path,
+            "sources": [self.source] + [source for source in self.sources if source != self.source]
+        }
+        if self.lines is not None:
+            metadata["start_line"] = self.start_line
+            metadata["end_line"] = self.end_line
+            metadata["symbol"] = ", ".join(self.symbols)
+        if self.page is not None:
+            metadata["page"] = self.page
+        if self.chunk_count > 1:
+            metadata["chunk_count"] = self.chunk_count
+        if self.truncated:
+            metadata["truncated"] = True
+        return Document(page_content=self.content, metadata=metadata)
+
+def _text_overlap(first, second):
+    """first の末尾と second の先頭が重なっている文字数（MIN_TEXT_OVERLAP 未満なら0）"""
+    if len(second) < MIN_TEXT_OVERLAP:
+        return 0
+    head = second[:MIN_TEXT_OVERLAP]
+    position = first.find(head, max(0, len(first) - len(second)))
+    while position != -1:
+        if second.startswith(first[position:]):
+            return len(first) - position
+        position = first.find(head, position + 1)
+    return 0
+
+def _shingles(text):
+    words = _WORD_PATTERN.findall(text)
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+def _containment(shingles, other_shingles):
+    """shingles のうち other_shingles にも含まれる割合（部分的なコピーも重複として扱えるように Jaccard 係数ではなくこちらを使う）"""
+    if not shingles:
+        return 1.0
+    return len(shingles & other_shingles) / len(shingles)
+
+def assemble_context(source_documents, token_budget):
+    """検索結果（順位順）をプロンプトに入れるコンテキストにまとめる
+
+    1. 同じファイル（PDFは同じページ）で重なっている・隣接しているチャンクを1つの範囲に結合する
+    2. 上位の範囲とほとんど同じ内容の範囲を除き、そのファイル名を上位の範囲の sources に加える
+    3. 順位の高い順に token_budget に収まる範囲を選ぶ（最初の範囲が収まらない場合は切り詰める）
+
+    戻り値: 順位順のドキュメントのリスト
+    """
+    spans = []
+    for rank, doc in enumerate(source_documents):
+        span = Span(rank, doc)
+        # 結合した結果、既存の別の範囲ともつながる場合があるので繰り返す
+        merged = True
+        while merged:
+            merged = False
+            for existing in spans:
+                if existing.try_merge(span):
+                    spans.remove(existing)
+                    span = existing
+                    merged = True
+                    break
+        spans.append(span)
+    spans.sort(key=lambda span: span.rank)
+
+    kept = []
+    for span in spans:
+        shingles = _shingles(span.content)
+        duplicate_of = next((other for other, other_shingles in kept
+                             if _containment(shingles, other_shingles) >= NEAR_DUPLICATE_THRESHOLD), None)
+        if duplicate_of is None:
+            kept.append((span, shingles))
+        elif span.source not in duplicate_of.sources:
+            duplicate_of.sources.append(span.source)
+
+    packed = []
+    remaining = token_budget
+    for span, _ in kept:
+        cost = estimate_tokens(span.content) + SNIPPET_OVERHEAD_TOKENS
+        if cost <= remaining:
+            packed.append(span)
+            remaining -= cost
+        elif not packed or remaining >= MIN_TRUNCATED_TOKENS:
+            span.truncate(max(remaining - SNIPPET_OVERHEAD_TOKENS, 1))
+            packed.append(span)
+            remaining -= estimate_tokens(span.content) + SNIPPET_OVERHEAD_TOKENS
+    return [span.to_document() for span in packed]
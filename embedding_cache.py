@@ -0,0 +1,174 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+# 設定
+EMBEDDING_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # ベクトル行列ファイルの上限サイズ（1GB）
+EMBEDDING_CACHE_DTYPE = "float16"  # 保存時のデータ型（float16 または float32）
+INITIAL_CAPACITY = 1024  # 最初に確保する行数（足りなくなったら倍に拡張）
+EVICTION_RATIO = 0.1  # 上限に達したときに追い出す行の割合
+
+def text_key(text):
+    """チャンク本文のSHA-256ハッシュ（キャッシュのキー）"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """チャンク本文のハッシュをキーにした、埋め込みベクトルのディスクキャッシュ
+
+    モデルごとのディレクトリに、ベクトルを並べたメモリマップ行列 (vectors.bin) と
+    キーから行番号への対応表 (index.json) を保存する。行列が上限サイズに達したら
+    最近使われていない行から追い出して再利用する。スレッドセーフではないため、
+    1つのスレッドからのみ使用すること。
+    """
+
+    def __init__(self, cache_dir, model_name, max_bytes=EMBEDDING_CACHE_MAX_BYTES, dtype=EMBEDDING_CACHE_DTYPE):
+        self.model_name = model_name
+        self.directory = os.path.join(cache_dir, model_name.replace("/", "__"))
+        self.vectors_path = os.path.join(self.directory, "vectors.bin")
+        self.index_path = os.path.join(self.directory, "index.json")
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+
+        self.dim = None
+        self.capacity = 0
+        self.rows = {}  # キー -> [行番号, 最終使用時刻（論理クロック）]
+        self.free_rows = []
+        self.next_row = 0
+        self.clock = 0
+        self._vectors = None
+        os.makedirs(self.directory, exist_ok=True)
+        self._load()
+
+    def _reset(self):
+        self.dim = None
+        self.capacity = 0
+        self.rows = {}
+        self.free_rows = []
+        self.next_row = 0
+        self.clock = 0
+        self._vectors = None
+
+    def _load(self):
+        # 対応表がなければキャッシュなし。それ以外の読み込み失敗（行列ファイルの欠損など）は破棄して作り直す
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"警告: 埋め込みキャッシュを読み込めなかったため破棄します: {e}")
+            return
+        try:
+            if np.dtype(index["dtype"]) != self.dtype:
+                print(f"警告: 埋め込みキャッシュのデータ型が異なるため破棄します: {self.directory}")
+                return
+            self.dim = index["dim"]
+            self.capacity = index["capacity"]
+            self.rows = index["rows"]
+            self.free_rows = index["free_rows"]
+            self.next_row = index["next_row"]
+            self.clock = index["clock"]
+            self._vectors = np.memmap(self.vectors_path, dtype=self.dtype, mode="r+", shape=(self.capacity, self.dim))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"警告: 埋め込みキャッシュを読み込めなかったため破棄します: {e}")
+            self._reset()
+
+    @property
+    def max_rows(self):
+        return max(1, self.max_bytes // (self.dim * self.dtype.itemsize))
+
+    def _resize(self, capacity):
+        """行列ファイルを拡張してメモリマップし直す"""
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._vectors = None
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(capacity * self.dim * self.dtype.itemsize)
+        self.capacity = capacity
+        self._vectors = np.memmap(self.vectors_path, dtype=self.dtype, mode="r+", shape=(self.capacity, self.dim))
+
+    def _evict(self):
+        """最近使われていない行を追い出して空き行にする"""
+        count = max(1, int(len(self.rows) * EVICTION_RATIO))
+        oldest = sorted(self.rows.items(), key=lambda item: item[1][1])[:count]
+        for key, (row, _) in oldest:
+            del self.rows[key]
+            self.free_rows.append(row)
+        # 追い出した行を上書きする前に対応表を保存し、古い対応表が新しいベクトルを指さないようにする
+        self.flush()
+        print(f"埋め込みキャッシュから{count}件を追い出しました")
+
+    def _allocate_row(self):
+        if self.free_rows:
+            return self.free_rows.pop()
+        if self.next_row >= self.capacity:
+            if self.capacity < self.max_rows:
+                self._resize(min(max(INITIAL_CAPACITY, self.capacity * 2), self.max_rows))
+            else:
+                self._evict()
+                return self.free_rows.pop()
+        row = self.next_row
+        self.next_row += 1
+        return row
+
+    def _put(self, key, vector):
+        if self.dim is None:
+            self.dim = len(vector)
+            self._resize(min(INITIAL_CAPACITY, self.max_rows))
+        row = self._allocate_row()
+        self._vectors[row] = vector
+        self.rows[key] = [row, self.clock]
+
+    def embed(self, texts, embed_fn):
+        """キャッシュにないテキストだけを embed_fn で埋め込み、(件数, 次元) の float32 行列を返す"""
+        self.clock += 1
+        keys = [text_key(text) for text in texts]
+        result = [None] * len(texts)
+
+        misses = {}
+        for position, key in enumerate(keys):
+            entry = self.rows.get(key)
+            if entry is not None:
+                entry[1] = self.clock
+                result[position] = np.asarray(self._vectors[entry[0]], dtype=np.float32)
+            else:
+                misses.setdefault(key, []).append(position)
+
+        self.hits += len(texts) - sum(len(positions) for positions in misses.values())
+        self.misses += len(misses)
+
+        if misses:
+            miss_keys = list(misses)
+            miss_texts = [texts[misses[key][0]] for key in miss_keys]
+            vectors = np.asarray(embed_fn(miss_texts), dtype=np.float32)
+            for key, vector in zip(miss_keys, vectors):
+                # 保存時の精度に丸めて、キャッシュの有無で結果が変わらないようにする
+                vector = vector.astype(self.dtype).astype(np.float32)
+                self._put(key, vector)
+                for position in misses[key]:
+                    result[position] = vector
+
+        return np.vstack(result) if result else np.zeros((0, self.dim or 0), dtype=np.float32)
+
+    def flush(self):
+        """ベクトルと対応表をディスクに書き出す"""
+        if self.dim is None:
+            return
+        self._vectors.flush()
+        index = {
+            "model_name": self.model_name,
+            "dim": self.dim,
+            "dtype": self.dtype.name,
+            "capacity": self.capacity,
+            "rows": self.rows,
+            "free_rows": self.free_rows,
+            "next_row": self.next_row,
+            "clock": self.clock
+        }
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
@@ -0,0 +1,132 @@
+import os
+import re
+import math
+import heapq
+import pickle
+from collections import Counter
+
+# 設定
+BM25_K1 = 1.5  # 単語の出現回数に対するスコアの飽和の強さ
+BM25_B = 0.75  # チャンクの長さによる正規化の強さ
+
+# 英数字の識別子、または日本語などの非ASCII文字の連続
+_WORD_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|[0-9]+|[^\x00-\x7f\s]+")
+# 識別子を camelCase / PascalCase / 数字の境界で分割する
+_SUBWORD_PATTERN = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+
+def lexical_index_path(persist_dir, collection_name):
+    """コレクションに対応する語彙インデックスファイルのパス"""
+    return os.path.join(persist_dir, f"lexical_{collection_name}.pkl")
+
+def tokenize(text):
+    """コード向けのトークン化
+
+    識別子はそのままの形（小文字化）に加えて snake_case と camelCase を分割した部分語も
+    トークンにする（例: getUserName → getusername, get, user, name）。
+    日本語などの非ASCII文字列は文字bigramにする。
+    """
+    tokens = []
+    for word in _WORD_PATTERN.findall(text):
+        if not word.isascii():
+            if len(word) == 1:
+                tokens.append(word)
+            else:
+                tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+            continue
+
+        lower = word.lower().strip("_")
+        if len(lower) < 2:
+            continue
+        tokens.append(lower)
+
+        parts = []
+        for piece in word.split("_"):
+            parts.extend(part.lower() for part in _SUBWORD_PATTERN.findall(piece))
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if len(part) > 1)
+    return tokens
+
+class LexicalIndex:
+    """チャンクIDをキーにしたBM25用の転置インデックス
+
+    チャンクの追加・削除に対応しており、インデクサーが増分更新で保守する。
+    ファイルにはチャンクごとの単語頻度だけを保存し、転置リストは読み込み時に組み立てる。
+    """
+
+    def __init__(self, doc_terms=None):
+        self.doc_terms = {}  # チャンクID -> {単語: 出現回数}
+        self.doc_lengths = {}
+        self.postings = {}  # 単語 -> {チャンクID: 出現回数}
+        self.total_length = 0
+        for chunk_id, terms in (doc_terms or {}).items():
+            self._add_terms(chunk_id, terms)
+
+    def __len__(self):
+        return len(self.doc_terms)
+
+    def _add_terms(self, chunk_id, terms):
+        self.doc_terms[chunk_id] = terms
+        length = sum(terms.values())
+        self.doc_lengths[chunk_id] = length
+        self.total_length += length
+        for term, count in terms.items():
+            self.postings.setdefault(term, {})[chunk_id] = count
+
+    def add(self, chunk_id, text):
+        """チャンクを追加する。同じIDが既にあれば置き換える"""
+        self.remove(chunk_id)
+        self._add_terms(chunk_id, dict(Counter(tokenize(text))))
+
+    def remove(self, chunk_id):
+        terms = self.doc_terms.pop(chunk_id, None)
+        if terms is None:
+            return
+        self.total_length -= self.doc_lengths.pop(chunk_id)
+        for term in terms:
+            posting = self.postings[term]
+            del posting[chunk_id]
+            if not posting:
+                del self.postings[term]
+
+    def search(self, query, k=20):
+        """BM25スコアの高い順に (チャンクID, スコア) のリストを返す"""
+        if not self.doc_terms:
+            return []
+        doc_count = len(self.doc_terms)
+        average_length = self.total_length / doc_count or 1.0
+
+        scores = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (doc_count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for chunk_id, count in posting.items():
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[chunk_id] / average_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * count * (BM25_K1 + 1) / (count + norm)
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def save(self, path):
+        """アトミックにファイルへ書き出す"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"doc_terms": self.doc_terms}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """ファイルから読み込む。存在しない場合は空のインデックスを返す"""
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            return cls()
+        return cls(data["doc_terms"])
+
+def reciprocal_rank_fusion_scores(rankings, k=60):
+    """複数の順位リスト（IDのリスト）を Reciprocal Rank Fusion で統合し、スコアの高い順に (ID, スコア) を返す"""
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,67 @@
+import os
+import hashlib
+import threading
+
+class OcrCache:
+    """画像のOCR結果のディスクキャッシュ
+
+    画像のバイト列・言語・Tesseractの設定・前処理の設定（バージョンを含む）から求めたハッシュをキーに、
+    抽出したテキストを1エントリ1ファイルで保存する。書き込みはアトミックなので、
+    インデクサーのワーカープロセスとWebアプリケーションから同時に使用できる。
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(image_bytes, lang, config, settings):
+        digest = hashlib.sha256(image_bytes)
+        digest.update(f"\0{lang}\0{config}\0{settings}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".txt")
+
+    def get(self, key):
+        """キャッシュされたテキストを返す。ない場合は None"""
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                text = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except OSError as e:
+            print(f"警告: OCRキャッシュを読み込めませんでした: {e}")
+            self.misses += 1
+            return None
+        self.hits += 1
+        return text
+
+    def put(self, key, text):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"警告: OCRキャッシュに書き込めませんでした: {e}")
+
+    def get_or_compute(self, image_bytes, lang, config, settings, ocr_fn):
+        """キャッシュになければ ocr_fn() でテキストを抽出して保存する。(テキスト, キャッシュヒットしたか) を返す
+
+        ocr_fn() が None を返した場合（OCRを行わなかった場合）は保存せず、空のテキストを返す。
+        """
+        key = self.key(image_bytes, lang, config, settings)
+        text = self.get(key)
+        if text is not None:
+            return text, True
+        text = ocr_fn()
+        if text is None:
+            return "", False
+        self.put(key, text)
+        return text, False
@@ -0,0 +1,173 @@
+import os
+import re
+import time
+
+# 設定
+GITIGNORE_FILE_NAME = ".gitignore"
+
+class IgnoreRule:
+    """.gitignore の1行分のルール"""
+
+    def __init__(self, pattern, negate, dir_only, regex):
+        self.pattern = pattern
+        self.negate = negate
+        self.dir_only = dir_only
+        self.regex = regex
+
+def _translate(pattern):
+    """gitignore のグロブを正規表現に変換する（/ を含まないパターンは任意の階層にマッチ）"""
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    parts = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            parts.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            parts.append("[^/]")
+            i += 1
+        elif pattern[i] == "[":
+            end = pattern.find("]", i + 2)
+            if end == -1:
+                parts.append(re.escape("["))
+                i += 1
+                continue
+            body = pattern[i + 1:end]
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            parts.append("[" + body.replace("\\", "\\\\") + "]")
+            i = end + 1
+        elif pattern[i] == "\\" and i + 1 < len(pattern):
+            parts.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    prefix = "" if anchored else "(?:.*/)?"
+    return re.compile("^" + prefix + "".join(parts) + "$")
+
+def parse_gitignore(text):
+    """.gitignore の内容を IgnoreRule のリストにする"""
+    rules = []
+    for line in text.splitlines():
+        line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        elif line.startswith("\\"):
+            line = line[1:]
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            continue
+        rules.append(IgnoreRule(line, negate, dir_only, _translate(line)))
+    return rules
+
+def _load_gitignore(path):
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            return parse_gitignore(f.read())
+    except OSError as e:
+        print(f"警告: {path} を読み込めませんでした: {e}")
+        return []
+
+def is_ignored(rule_chain, rel_path, is_dir):
+    """ルートからのディレクトリごとのルールを順に評価し、最後にマッチしたルールで判定する"""
+    ignored = False
+    for base, rules in rule_chain:
+        sub_path = rel_path[len(base):]
+        for rule in rules:
+            if rule.dir_only and not is_dir:
+                continue
+            if rule.regex.match(sub_path):
+                ignored = not rule.negate
+    return ignored
+
+def walk_files(root, extensions, exclude_dirs=(), use_gitignore=True):
+    """root 以下を1回だけ走査し、拡張子ごとにファイルパスを振り分けて返す
+
+    exclude_dirs に含まれる名前のディレクトリと .gitignore で除外されたディレクトリには
+    降りない。glob と同様に名前が "." で始まるファイルとディレクトリは対象外。
+    シンボリックリンクはたどるが、同じディレクトリを2度訪れないようにしてループを防ぐ。
+
+    戻り値: {拡張子: [ファイルパス, ...]}（extensions に含まれる拡張子のみ）
+    """
+    started_at = time.time()
+    extensions = set(extensions)
+    exclude_dirs = set(exclude_dirs)
+    found = {ext: [] for ext in extensions}
+    dir_count = 0
+    pruned_count = 0
+
+    try:
+        root_stat = os.stat(root)
+    except OSError as e:
+        print(f"警告: {root} を走査できませんでした: {e}")
+        return found
+    visited = {(root_stat.st_dev, root_stat.st_ino)}
+
+    # (ディレクトリのパス, ルートからの相対パス（末尾に/）, 適用される .gitignore ルール)
+    stack = [(root, "", [])]
+    while stack:
+        dir_path, rel_dir, rule_chain = stack.pop()
+        dir_count += 1
+        try:
+            with os.scandir(dir_path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            print(f"警告: {dir_path} を読み込めませんでした: {e}")
+            continue
+
+        if use_gitignore and any(entry.name == GITIGNORE_FILE_NAME for entry in entries):
+            rules = _load_gitignore(os.path.join(dir_path, GITIGNORE_FILE_NAME))
+            if rules:
+                rule_chain = rule_chain + [(rel_dir, rules)]
+
+        subdirs = []
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            rel_path = rel_dir + entry.name
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+
+            if is_dir:
+                if entry.name in exclude_dirs or is_ignored(rule_chain, rel_path, True):
+                    pruned_count += 1
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError as e:
+                    print(f"警告: {entry.path} の情報を取得できませんでした: {e}")
+                    continue
+                key = (stat.st_dev, stat.st_ino)
+                if key in visited:
+                    if entry.is_symlink():
+                        print(f"警告: シンボリックリンクのループをスキップしました: {rel_path}")
+                    continue
+                visited.add(key)
+                subdirs.append((entry.path, rel_path + "/", rule_chain))
+                continue
+
+            ext = os.path.splitext(entry.name)[1]
+            if ext in extensions and not is_ignored(rule_chain, rel_path, False):
+                found[ext].append(entry.path)
+
+        # 名前順に処理するため逆順に積む
+        stack.extend(reversed(subdirs))
+
+    file_count = sum(len(paths) for paths in found.values())
+    print(f"ファイル探索: {dir_count}ディレクトリを走査し、{file_count}ファイルが見つかりました"
+          f"（除外したディレクトリ: {pruned_count}, {time.time() - started_at:.2f}秒）")
+    return found
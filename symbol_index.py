@@ -0,0 +1,89 @@
+import os
+import re
+import pickle
+
+# 質問文中の識別子（ドットでつながった修飾名を含む。ASCIIのみなので、続く日本語は識別子に含めない）
+_IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_$][A-Za-z0-9_$]*(?:\.[A-Za-z_$][A-Za-z0-9_$]*)*")
+# バッククォートで囲まれた部分
+_BACKTICK_PATTERN = re.compile(r"`([^`]+)`")
+
+def symbol_index_path(persist_dir, collection_name):
+    """コレクションに対応するシンボルインデックスファイルのパス"""
+    return os.path.join(persist_dir, f"symbols_{collection_name}.pkl")
+
+def _looks_like_identifier(word):
+    """普通の英単語ではなくコードの識別子らしいか（snake_case、camelCase、修飾名など）"""
+    return "_" in word or "." in word or "$" in word or any(c.isupper() for c in word[1:]) or any(c.isdigit() for c in word)
+
+def find_identifiers(question):
+    """質問文から識別子らしい語を取り出す
+
+    バッククォートで囲まれた語はそのまま、それ以外は snake_case・camelCase・修飾名
+    （Foo.bar）など識別子らしい形の語だけを対象にする。"()" は取り除く。
+    """
+    identifiers = []
+    for quoted in _BACKTICK_PATTERN.findall(question):
+        identifiers.extend(_IDENTIFIER_PATTERN.findall(quoted))
+    unquoted = _BACKTICK_PATTERN.sub(" ", question)
+    identifiers.extend(word for word in _IDENTIFIER_PATTERN.findall(unquoted) if _looks_like_identifier(word))
+    return list(dict.fromkeys(identifiers))
+
+class SymbolIndex:
+    """関数・クラス・メソッドの定義の位置（ファイル、行、チャンクID）を名前で引く表
+
+    ファイルにはファイルごとの定義の一覧だけを保存し、名前からの辞書は読み込み時に組み立てる。
+    修飾名（Foo.bar）と最後の部分（bar）のどちらでも引ける。インデクサーが増分更新で保守する。
+    """
+
+    def __init__(self, files=None):
+        self.files = {}  # ファイルの相対パス -> [(修飾名, 行番号, チャンクID), ...]
+        self.definitions = {}  # 名前 -> [(ファイルの相対パス, 修飾名, 行番号, チャンクID), ...]
+        for rel_path, entries in (files or {}).items():
+            self.set_file(rel_path, entries)
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.files.values())
+
+    def _keys(self, name):
+        short_name = name.rsplit(".", 1)[-1]
+        return {name, short_name}
+
+    def remove_file(self, rel_path):
+        for name, _, _ in self.files.pop(rel_path, []):
+            for key in self._keys(name):
+                remaining = [entry for entry in self.definitions.get(key, []) if entry[0] != rel_path]
+                if remaining:
+                    self.definitions[key] = remaining
+                else:
+                    self.definitions.pop(key, None)
+
+    def set_file(self, rel_path, entries):
+        """ファイルの定義の一覧を置き換える"""
+        self.remove_file(rel_path)
+        if not entries:
+            return
+        self.files[rel_path] = [tuple(entry) for entry in entries]
+        for name, line, chunk_id in self.files[rel_path]:
+            for key in self._keys(name):
+                self.definitions.setdefault(key, []).append((rel_path, name, line, chunk_id))
+
+    def lookup(self, name):
+        """名前（修飾名または最後の部分）の定義を [(ファイルの相対パス, 修飾名, 行番号, チャンクID), ...] で返す"""
+        return self.definitions.get(name, [])
+
+    def save(self, path):
+        """アトミックにファイルへ書き出す"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"files": self.files}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """ファイルから読み込む。存在しない場合は空のインデックスを返す"""
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            return cls()
+        return cls(data["files"])
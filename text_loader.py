@@ -0,0 +1,67 @@
+import os
+import mmap
+
+# 設定
+MAX_FILE_BYTES = 1024 * 1024  # これより大きいファイルは読み込まない（1MB）
+SAMPLE_BYTES = 64 * 1024  # 判定に使うファイル先頭のバイト数
+MAX_NON_PRINTABLE_RATIO = 0.1  # 制御文字の割合がこれを超えたらバイナリとみなす
+MAX_AVERAGE_LINE_LENGTH = 300  # 平均行長がこれを超えたら minify されたファイルとみなす
+MAX_LINE_LENGTH = 5000  # これより長い行があれば minify されたファイルとみなす
+GENERATED_MARKERS = [b"@generated", b"DO NOT EDIT", b"Code generated by"]  # 自動生成ファイルを示す先頭付近の文字列
+MINIFIED_NAME_MARKERS = [".min.", ".bundle.", ".chunk."]  # minify・バンドルされたファイル名に含まれる文字列
+ENCODINGS = ["utf-8", "cp932", "euc-jp"]  # 順に試す文字コード（すべて失敗したら latin-1）
+
+# タブ・改行・復帰・改ページ・ESC以外の ASCII 制御文字
+_CONTROL_BYTES = bytes(set(range(32)) - {9, 10, 12, 13, 27}) + b"\x7f"
+
+def _non_printable_ratio(sample):
+    if not sample:
+        return 0.0
+    return (len(sample) - len(sample.translate(None, _CONTROL_BYTES))) / len(sample)
+
+def skip_reason(file_name, size, sample):
+    """インデックスに含めるべきでないファイルなら理由を、そうでなければ None を返す"""
+    if size > MAX_FILE_BYTES:
+        return f"サイズ上限超過 ({size}バイト)"
+    if any(marker in file_name for marker in MINIFIED_NAME_MARKERS):
+        return "minify されたファイル名"
+    if b"\x00" in sample or _non_printable_ratio(sample) > MAX_NON_PRINTABLE_RATIO:
+        return "バイナリファイル"
+    head = sample[:1024]
+    if any(marker in head for marker in GENERATED_MARKERS):
+        return "自動生成ファイル"
+    lines = sample.split(b"\n")
+    if len(sample) >= 1024 and len(sample) / len(lines) > MAX_AVERAGE_LINE_LENGTH:
+        return "minify されたファイル（平均行長）"
+    if any(len(line) > MAX_LINE_LENGTH for line in lines):
+        return "minify されたファイル（長い行）"
+    return None
+
+def decode_text(data):
+    """BOM を確認したうえで ENCODINGS を順に試してデコードする"""
+    if data.startswith(b"\xef\xbb\xbf"):
+        return data[3:].decode("utf-8", errors="replace")
+    for encoding in ENCODINGS:
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode("latin-1")
+
+def load_text(file_path):
+    """テキストファイルを mmap 経由で読み込む
+
+    戻り値: (テキスト, スキップ理由)。スキップした場合はテキストが None になる。
+    判定はファイル全体を読み込む前に先頭部分だけで行う。
+    """
+    with open(file_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return "", None
+        if size > MAX_FILE_BYTES:
+            return None, skip_reason(os.path.basename(file_path), size, b"")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            reason = skip_reason(os.path.basename(file_path), size, mapped[:SAMPLE_BYTES])
+            if reason:
+                return None, reason
+            return decode_text(mapped[:]), None
@@ -1,15 +1,22 @@
-from fastapi import FastAPI, BackgroundTasks, HTTPException, Request, File, UploadFile, Form
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, Request, File, UploadFile, Form
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 import uvicorn
 import os
-import subprocess
+import asyncio
+import queue
 import base64
+import json
+import threading
+import uuid
+from concurrent.futures.process import BrokenProcessPool
 from typing import Optional, List, Dict, Any
 import time
 
+# クエリ処理モジュール（ChromaDB・モデル・LLMは起動時の warmup で初期化される）
+import code_query
 # 画像処理用のライブラリをインポート
 try:
     from PIL import Image
@@ -26,12 +33,23 @@ app = FastAPI()
 # HTMLテンプレートディレクトリの設定
 templates = Jinja2Templates(directory="templates")
 
+# 設定
+QUERY_CONCURRENCY = int(os.environ.get("QUERY_CONCURRENCY", 8))  # 同時に処理する質問の最大数
+MAX_BATCH_QUESTIONS = 50  # /query/batch で一度に受け付ける質問の最大数
+MAX_SEARCH_LIMIT = 50  # /search で1ページに返す結果の最大数
+MAX_SEARCH_OFFSET = 200  # /search でページ送りできる最大の位置
+INDEX_WORKERS = int(os.environ.get("INDEX_WORKERS", min(os.cpu_count() or 1, 4)))  # アプリ内でのインデックス作成のワーカープロセス数
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", 2))  # アップロードされた画像をOCRするワーカープロセス数
+OCR_QUEUE_SIZE = int(os.environ.get("OCR_QUEUE_SIZE", 16))  # 受け付けるOCR処理の最大数（実行中と待機中の合計）
+OCR_RETRY_AFTER = 5  # OCRの受付を断ったときに Retry-After で返す秒数
+IMAGE_JOB_TTL = 600  # 非同期ジョブの結果を保持する秒数
+
 # インデックス作成の状態を管理するグローバル変数
 indexing_status = {
     "is_running": False,
     "start_time": None,
     "end_time": None,
-    "status": "idle",  # idle, running, completed, error
+    "status": "idle",  # idle, running, completed, cancelled, error
     "message": "",
     "error": None
 }
@@ -39,6 +57,25 @@ indexing_status = {
 class QueryRequest(BaseModel):
     question: str
 
+class QueryBatchRequest(BaseModel):
+    questions: List[str]
+
+class QueryBatchResponse(BaseModel):
+    results: List[Dict[str, Any]]
+
+class SearchRequest(BaseModel):
+    query: str
+    limit: int = 10
+    offset: int = 0
+
+class SearchResponse(BaseModel):
+    query: str
+    offset: int
+    limit: int
+    has_more: bool
+    took_ms: float
+    results: List[Dict[str, Any]]
+
 class IndexResponse(BaseModel):
     status: str
 
@@ -49,6 +86,14 @@ class IndexStatusResponse(BaseModel):
     start_time: Optional[float] = None
     end_time: Optional[float] = None
     duration: Optional[float] = None
+    phase: Optional[str] = None
+    files_discovered: Optional[int] = None
+    files_to_process: Optional[int] = None
+    files_processed: Optional[int] = None
+    bytes_read: Optional[int] = None
+    chunks: Optional[int] = None
+    chunks_per_second: Optional[float] = None
+    eta_seconds: Optional[float] = None
 
 class QueryResponse(BaseModel):
     answer: str
@@ -58,48 +103,257 @@ class ImageQueryRequest(BaseModel):
     image_data: str  # Base64エンコードされた画像データ
     question: Optional[str] = None  # 画像に関する質問（オプション）
 
-# インデックス作成のバックグラウンドタスク
-def run_indexer():
-    global indexing_status
+class QueryStatusResponse(BaseModel):
+    limit: int
+    active: int
+    waiting: int
+    completed: int
+
+class ConcurrencyLimiter:
+    """同時実行数を制限し、実行中・待機中のリクエスト数を数える"""
     
-    try:
-        # 状態を更新
-        indexing_status["is_running"] = True
-        indexing_status["start_time"] = time.time()
-        indexing_status["status"] = "running"
-        indexing_status["message"] = "インデックス作成を実行中..."
-        indexing_status["error"] = None
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self.completed = 0
+        self._semaphore = None
+    
+    async def __aenter__(self):
+        # セマフォは実行中のイベントループ上で作成する
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        self.active -= 1
+        self.completed += 1
+        self._semaphore.release()
+        return False
+    
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": self.waiting,
+            "completed": self.completed
+        }
+
+query_limiter = ConcurrencyLimiter(QUERY_CONCURRENCY)
+
+class OcrPoolUnavailable(Exception):
+    """OCRのワーカープロセスが利用できない"""
+
+class OcrPool:
+    """アップロードされた画像のOCRを行うプロセスプール
+    
+    イベントループをブロックしないよう、OCRはワーカープロセスで実行する。実行中と待機中の
+    合計が queue_size に達したら新しい処理を受け付けない（呼び出し側は429を返す）。
+    """
+    
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.pending = 0
+        self.rejected = 0
+        self._executor = None
+        self._lock = threading.Lock()
+    
+    def try_admit(self):
+        """空きがあれば枠を確保して True を返す"""
+        with self._lock:
+            if self.pending >= self.queue_size:
+                self.rejected += 1
+                return False
+            self.pending += 1
+            return True
+    
+    def release(self):
+        """try_admit() で確保した枠を返す"""
+        with self._lock:
+            self.pending -= 1
+    
+    def _get_executor(self):
+        import code_indexer
+        with self._lock:
+            if self._executor is None:
+                self._executor = code_indexer.create_worker_pool(self.workers)
+            return self._executor
+    
+    async def run(self, func, *args):
+        """func をワーカープロセスで実行する"""
+        try:
+            executor = self._get_executor()
+            return await asyncio.wrap_future(executor.submit(func, *args))
+        except BrokenProcessPool as e:
+            # ワーカーが異常終了した場合は次の呼び出しでプールを作り直す
+            with self._lock:
+                self._executor = None
+            raise OcrPoolUnavailable(str(e))
+    
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "pending": self.pending,
+            "rejected": self.rejected
+        }
+
+ocr_pool = OcrPool(OCR_WORKERS, OCR_QUEUE_SIZE)
+
+class ImageJobStore:
+    """非同期モードで受け付けた画像処理ジョブの状態と結果を保持する"""
+    
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.jobs = {}
+    
+    def _expire(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.jobs.items() if job["finished_at"] and job["finished_at"] + self.ttl <= now]:
+            del self.jobs[job_id]
+    
+    def create(self, coroutine):
+        """コルーチンをバックグラウンドで実行するジョブを作成し、ジョブIDを返す"""
+        self._expire()
+        job_id = uuid.uuid4().hex
+        job = {"status": "running", "created_at": time.time(), "finished_at": None, "result": None, "error": None}
+        self.jobs[job_id] = job
         
-        # インデックス作成を実行
-        result = subprocess.run(["python", "code_indexer.py"], check=True, capture_output=True, text=True)
+        async def run():
+            try:
+                job["result"] = await coroutine
+                job["status"] = "completed"
+            except Exception as e:
+                job["error"] = str(e)
+                job["status"] = "error"
+            finally:
+                job["finished_at"] = time.time()
         
-        # 成功した場合の状態更新
-        indexing_status["status"] = "completed"
-        indexing_status["message"] = "インデックス作成が完了しました"
-        indexing_status["end_time"] = time.time()
-    except subprocess.CalledProcessError as e:
-        # エラーが発生した場合の状態更新
-        indexing_status["status"] = "error"
-        indexing_status["message"] = f"インデックス作成中にエラーが発生しました"
-        indexing_status["error"] = str(e) + "\n" + e.stdout + "\n" + e.stderr
-        indexing_status["end_time"] = time.time()
-    finally:
-        # 実行状態を更新
-        indexing_status["is_running"] = False
+        job["task"] = asyncio.create_task(run())
+        return job_id
+    
+    def get(self, job_id):
+        self._expire()
+        return self.jobs.get(job_id)
+
+image_jobs = ImageJobStore(IMAGE_JOB_TTL)
+
+# 起動時にクエリ用のリソース（ChromaDBクライアント、エンベディングモデル、LLM）を初期化する
+# ChromaDBがまだ起動していなくても、バックグラウンドで再試行し続けるため再起動は不要
+@app.on_event("startup")
+async def start_warmup():
+    threading.Thread(target=code_query.warmup, name="query-warmup", daemon=True).start()
+
+# リソースの初期化状態を確認するエンドポイント（準備ができていなければ503）
+@app.get("/ready")
+async def get_readiness():
+    status = code_query.readiness()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+class IndexingWorker:
+    """アプリ内に常駐するインデックス作成ワーカー
+    
+    1つのスレッドでインデックス作成ジョブを順に実行する。エンベディングモデルと
+    ChromaDBクライアントはクエリ側と共有する。ファイル処理用のプロセスプールは
+    ジョブごとに作成し、ジョブが終わったら終了して待機中にプロセスを残さない。
+    """
+    
+    def __init__(self, workers=INDEX_WORKERS):
+        self.workers = workers
+        self.progress = None
+        self._jobs = queue.Queue()
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="indexing-worker", daemon=True)
+        self._thread.start()
+    
+    def submit(self, full_rebuild=False):
+        """ジョブを投入する。既に実行中の場合は False を返す"""
+        import code_indexer
+        with self._lock:
+            if indexing_status["is_running"]:
+                return False
+            indexing_status["is_running"] = True
+            indexing_status["start_time"] = time.time()
+            indexing_status["end_time"] = None
+            indexing_status["status"] = "running"
+            indexing_status["message"] = "インデックス作成を実行中..."
+            indexing_status["error"] = None
+            self._cancel_event.clear()
+            self.progress = code_indexer.IndexProgress()
+            self._jobs.put(full_rebuild)
+            return True
+    
+    def cancel(self):
+        """実行中のジョブにキャンセルを要求する。実行中でなければ False を返す"""
+        if not indexing_status["is_running"]:
+            return False
+        self._cancel_event.set()
+        indexing_status["message"] = "キャンセルしています..."
+        return True
+    
+    def _run(self):
+        while True:
+            full_rebuild = self._jobs.get()
+            import code_indexer
+            executor = code_indexer.create_worker_pool(self.workers) if self.workers > 1 else None
+            try:
+                code_indexer.main(
+                    full_rebuild=full_rebuild,
+                    workers=self.workers,
+                    progress=self.progress,
+                    cancel_event=self._cancel_event,
+                    executor=executor
+                )
+                indexing_status["status"] = "completed"
+                indexing_status["message"] = "インデックス作成が完了しました"
+            except code_indexer.IndexingCancelled:
+                indexing_status["status"] = "cancelled"
+                indexing_status["message"] = "インデックス作成をキャンセルしました"
+            except Exception as e:
+                import traceback
+                indexing_status["status"] = "error"
+                indexing_status["message"] = "インデックス作成中にエラーが発生しました"
+                indexing_status["error"] = traceback.format_exc()
+                print(f"エラー: インデックス作成中に問題が発生しました: {e}")
+            finally:
+                if executor is not None:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                indexing_status["end_time"] = time.time()
+                indexing_status["is_running"] = False
+
+indexing_worker = IndexingWorker()
+
+@app.on_event("startup")
+async def start_indexing_worker():
+    indexing_worker.start()
 
 # コードベースのインデックスを作成するエンドポイント
 @app.post("/index", response_model=IndexResponse)
-async def index_code(background_tasks: BackgroundTasks):
-    global indexing_status
-    
-    # 既に実行中の場合はエラーを返す
-    if indexing_status["is_running"]:
+async def index_code(full: bool = False):
+    # full=true の場合はマニフェストを無視してすべて作り直す
+    if not indexing_worker.submit(full):
+        # 既に実行中の場合はエラーを返す
         return {"status": "already_running", "message": "インデックス作成は既に実行中です"}
-    
-    # バックグラウンドでインデックス作成を実行
-    background_tasks.add_task(run_indexer)
     return {"status": "processing", "message": "コードベースのインデックス作成を開始しました。これには数分かかる場合があります。"}
 
+# 実行中のインデックス作成をキャンセルするエンドポイント
+@app.post("/index/cancel", response_model=IndexResponse)
+async def cancel_index():
+    if not indexing_worker.cancel():
+        return {"status": "not_running", "message": "実行中のインデックス作成はありません"}
+    return {"status": "cancelling", "message": "インデックス作成のキャンセルを要求しました"}
+
 # インデックス作成の状態を確認するエンドポイント
 @app.get("/index/status", response_model=IndexStatusResponse)
 async def get_index_status():
@@ -120,33 +374,197 @@ async def get_index_status():
         elif indexing_status["is_running"]:
             response["duration"] = time.time() - indexing_status["start_time"]
     
+    # 進捗（発見・処理済みファイル数、読み込んだバイト数、チャンク/秒、残り時間の目安）
+    if indexing_worker.progress is not None:
+        response.update(indexing_worker.progress.snapshot())
+    
     return response
 
+def format_sources(source_documents):
+    """参照ドキュメントをレスポンス用の形式に整形"""
+    sources = []
+    for doc in source_documents:
+        sources.append({
+            "file": doc.metadata.get("source", "Unknown"),
+            "files": doc.metadata.get("sources", [doc.metadata.get("source", "Unknown")]),
+            "location": code_query.describe_location(doc),
+            "content": doc.page_content[:200] + "..." if len(doc.page_content) > 200 else doc.page_content
+        })
+    return sources
+
+def sse_event(event, data):
+    """Server-Sent Events形式のメッセージを作成"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
 # コードベースに対して質問するエンドポイント
 @app.post("/query", response_model=QueryResponse)
 async def query_code(request: QueryRequest):
     try:
-        # code_query.pyからquery_code関数をインポート
-        from code_query import query_code
-        
-        # 質問を処理
-        result = query_code(request.question)
+        # 質問を処理（同時実行数を超えた分は待機させる。同じ質問の処理を待つだけのリクエストは数えない）
+        result = await code_query.aquery_code(request.question, limiter=query_limiter)
         
         # レスポンスを整形
-        sources = []
-        for doc in result["source_documents"]:
-            sources.append({
-                "file": doc.metadata.get("source", "Unknown"),
-                "content": doc.page_content[:200] + "..." if len(doc.page_content) > 200 else doc.page_content
-            })
-        
-        return {"answer": result["result"], "sources": sources}
+        return {"answer": result["result"], "sources": format_sources(result["source_documents"])}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"クエリ処理中にエラーが発生しました: {str(e)}")
+
+# 複数の質問にまとめて回答するエンドポイント
+# 質問のベクトル化と検索は一括で行い、LLMの呼び出しは code_query.BATCH_LLM_CONCURRENCY 件ずつ並行して行う
+@app.post("/query/batch", response_model=QueryBatchResponse)
+async def query_code_batch(request: QueryBatchRequest):
+    if len(request.questions) > MAX_BATCH_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"一度に送信できる質問は{MAX_BATCH_QUESTIONS}件までです")
+    try:
+        # 検索とLLMの呼び出し1回ごとに1件として同時実行数を数える（一括質問で QUERY_CONCURRENCY を超えないように）
+        results = await code_query.aquery_code_batch(request.questions, limiter=query_limiter)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"クエリ処理中にエラーが発生しました: {str(e)}")
+    
+    response = []
+    for question, result in zip(request.questions, results):
+        if "error" in result:
+            response.append({"question": question, "error": result["error"]})
+        else:
+            response.append({
+                "question": question,
+                "answer": result["result"],
+                "sources": format_sources(result["source_documents"])
+            })
+    return {"results": response}
+
+# LLMを使わずに関連するチャンクだけを返すエンドポイント（エディタ連携などで使う）
+# offset と limit でページ送りでき、各結果にはスコア・ファイル・行範囲・ハイライトを含める
+@app.post("/search", response_model=SearchResponse)
+async def search_code(request: SearchRequest):
+    if not 1 <= request.limit <= MAX_SEARCH_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit は1から{MAX_SEARCH_LIMIT}の範囲で指定してください")
+    if not 0 <= request.offset <= MAX_SEARCH_OFFSET:
+        raise HTTPException(status_code=400, detail=f"offset は0から{MAX_SEARCH_OFFSET}の範囲で指定してください")
+    started_at = time.perf_counter()
+    try:
+        result = await asyncio.to_thread(code_query.search_code, request.query, request.limit, request.offset)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"検索中にエラーが発生しました: {str(e)}")
+    if result is None:
+        raise HTTPException(status_code=503, detail="インデックスがまだ作成されていません")
+    
+    return {
+        "query": request.query,
+        "offset": request.offset,
+        "limit": request.limit,
+        "has_more": result["has_more"],
+        "took_ms": round((time.perf_counter() - started_at) * 1000, 1),
+        "results": result["results"]
+    }
+
+# 回答をServer-Sent Eventsでストリーミングするエンドポイント
+# 検索が終わった時点で sources イベントを送り、その後 token イベントで回答を少しずつ送る
+@app.post("/query/stream")
+async def query_code_stream(request: QueryRequest):
+    async def event_stream():
+        async with query_limiter:
+            try:
+                async for kind, payload in code_query.astream_query(request.question):
+                    if kind == "sources":
+                        yield sse_event("sources", format_sources(payload))
+                    else:
+                        yield sse_event("token", payload)
+                yield sse_event("done", {})
+            except Exception as e:
+                yield sse_event("error", {"detail": f"クエリ処理中にエラーが発生しました: {str(e)}"})
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# 質問処理の同時実行数と待ち行列の長さを確認するエンドポイント
+@app.get("/query/status", response_model=QueryStatusResponse)
+async def get_query_status():
+    return query_limiter.stats()
+
+# 検索・回答の段階ごとの所要時間（回数、平均、最大、直近）を確認するエンドポイント
+@app.get("/query/timings", response_model=Dict[str, Any])
+async def get_query_timings():
+    return code_query.stage_timings.stats()
+
+# 回答キャッシュのヒット数・ミス数を確認するエンドポイント
+@app.get("/query/cache", response_model=Dict[str, Any])
+async def get_answer_cache_stats():
+    stats = code_query.answer_cache.stats()
+    # 同時に届いた同じ質問を1つの処理にまとめた件数
+    stats["single_flight"] = dict(code_query.single_flight_stats)
+    return stats
+
+def build_image_prompt(extracted_text, question):
+    """画像から抽出したテキストに関する質問のプロンプトを作成"""
+    return f"""
+以下は画像から抽出されたテキストです:
+
+{extracted_text}
+
+質問: {question}
+
+上記の抽出されたテキストに基づいて、質問に対する回答を日本語で提供してください。
+テキストに関連する情報がない場合は、「画像から抽出されたテキストには関連情報がありません」と回答してください。
+"""
+
+async def run_image_job(image_bytes, result, question):
+    """画像からテキストを抽出し、質問があればLLMで回答する
+    
+    ocr_pool.try_admit() で枠を確保してから呼ぶ。枠はOCRが終わった時点で返す。
+    """
+    import code_indexer
+    try:
+        # OCRキャッシュにあればワーカーを使わない
+        extracted_text = code_indexer.cached_image_text(image_bytes)
+        if extracted_text is None:
+            # 文字を読むために送られた画像なので、文字を含むかどうかの事前判定はせずにOCRする
+            extracted_text, _ = await ocr_pool.run(code_indexer.extract_image_text_task, image_bytes, False)
+    finally:
+        ocr_pool.release()
+    result["extracted_text"] = extracted_text
+    
+    # 質問がある場合、LLMを使用して回答
+    if question:
+        response = await code_query.get_llm().ainvoke(build_image_prompt(extracted_text, question))
+        result["answer"] = response.content
+    
+    return result
+
+async def handle_image_request(image_bytes, result, question, async_job):
+    """OCRの受付を確認し、同期モードでは結果を、非同期モードではジョブIDを返す"""
+    if not ocr_pool.try_admit():
+        return JSONResponse(
+            status_code=429,
+            headers={"Retry-After": str(OCR_RETRY_AFTER)},
+            content={"error": "画像処理が混み合っています。しばらくしてから再度お試しください。"}
+        )
+    
+    coroutine = run_image_job(image_bytes, result, question)
+    if async_job:
+        job_id = image_jobs.create(coroutine)
+        return JSONResponse(
+            status_code=202,
+            content={"job_id": job_id, "status": "running", "status_url": f"/image_jobs/{job_id}"}
+        )
+    
+    try:
+        return await coroutine
+    except OcrPoolUnavailable:
+        return JSONResponse(
+            status_code=503,
+            headers={"Retry-After": str(OCR_RETRY_AFTER)},
+            content={"error": "画像処理のワーカーを再起動しています。しばらくしてから再度お試しください。"}
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"画像処理中にエラーが発生しました: {str(e)}")
 
 # 画像をアップロードして情報を抽出するエンドポイント
+# async_job=true を指定するとすぐにジョブIDを返し、結果は /image_jobs/{job_id} で取得する
 @app.post("/process_image", response_model=Dict[str, Any])
-async def process_image(file: UploadFile = File(...), question: str = Form(None)):
+async def process_image(file: UploadFile = File(...), question: str = Form(None), async_job: bool = False):
     if not HAS_IMAGE_PROCESSING:
         return JSONResponse(
             status_code=501,
@@ -154,51 +572,28 @@ async def process_image(file: UploadFile = File(...), question: str = Form(None)
         )
     
     try:
-        # 画像を読み込む
+        # 画像を読み込んで保存
         contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-        
-        # 画像からテキストを抽出
-        extracted_text = pytesseract.image_to_string(image, lang='jpn+eng')
-        
-        # 画像を保存
         image_path = os.path.join("static", "images", file.filename)
-        os.makedirs(os.path.dirname(image_path), exist_ok=True)
-        with open(image_path, "wb") as f:
-            f.write(contents)
         
-        result = {
-            "filename": file.filename,
-            "extracted_text": extracted_text,
-            "image_path": f"/static/images/{file.filename}"
-        }
-        
-        # 質問がある場合、LLMを使用して回答
-        if question:
-            # code_query.pyからquery_code関数をインポート
-            from code_query import llm
-            
-            prompt = f"""
-以下は画像から抽出されたテキストです:
-
-{extracted_text}
-
-質問: {question}
-
-上記の抽出されたテキストに基づいて、質問に対する回答を日本語で提供してください。
-テキストに関連する情報がない場合は、「画像から抽出されたテキストには関連情報がありません」と回答してください。
-"""
-            response = llm.invoke(prompt)
-            result["answer"] = response.content
+        def save_image():
+            os.makedirs(os.path.dirname(image_path), exist_ok=True)
+            with open(image_path, "wb") as f:
+                f.write(contents)
         
-        return result
-    
+        await asyncio.to_thread(save_image)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"画像処理中にエラーが発生しました: {str(e)}")
+    
+    result = {
+        "filename": file.filename,
+        "image_path": f"/static/images/{file.filename}"
+    }
+    return await handle_image_request(contents, result, question, async_job)
 
 # Base64エンコードされた画像データを処理するエンドポイント
 @app.post("/process_image_base64", response_model=Dict[str, Any])
-async def process_image_base64(request: ImageQueryRequest):
+async def process_image_base64(request: ImageQueryRequest, async_job: bool = False):
     if not HAS_IMAGE_PROCESSING:
         return JSONResponse(
             status_code=501,
@@ -208,48 +603,44 @@ async def process_image_base64(request: ImageQueryRequest):
     try:
         # Base64データをデコード
         image_data = base64.b64decode(request.image_data)
-        image = Image.open(io.BytesIO(image_data))
-        
-        # 画像からテキストを抽出
-        extracted_text = pytesseract.image_to_string(image, lang='jpn+eng')
         
         # 一意のファイル名を生成
-        import uuid
         filename = f"{uuid.uuid4()}.png"
-        
-        # 画像を保存
         image_path = os.path.join("static", "images", filename)
-        os.makedirs(os.path.dirname(image_path), exist_ok=True)
-        image.save(image_path)
         
-        result = {
-            "filename": filename,
-            "extracted_text": extracted_text,
-            "image_path": f"/static/images/{filename}"
-        }
+        # 画像をPNGとして保存（デコードとエンコードはイベントループの外で行う）
+        def save_image():
+            image = Image.open(io.BytesIO(image_data))
+            os.makedirs(os.path.dirname(image_path), exist_ok=True)
+            image.save(image_path)
         
-        # 質問がある場合、LLMを使用して回答
-        if request.question:
-            # code_query.pyからquery_code関数をインポート
-            from code_query import llm
-            
-            prompt = f"""
-以下は画像から抽出されたテキストです:
-
-{extracted_text}
-
-質問: {request.question}
-
-上記の抽出されたテキストに基づいて、質問に対する回答を日本語で提供してください。
-テキストに関連する情報がない場合は、「画像から抽出されたテキストには関連情報がありません」と回答してください。
-"""
-            response = llm.invoke(prompt)
-            result["answer"] = response.content
-        
-        return result
-    
+        await asyncio.to_thread(save_image)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"画像処理中にエラーが発生しました: {str(e)}")
+    
+    result = {
+        "filename": filename,
+        "image_path": f"/static/images/{filename}"
+    }
+    return await handle_image_request(image_data, result, request.question, async_job)
+
+# 非同期モードの画像処理ジョブの状態と結果を取得するエンドポイント
+@app.get("/image_jobs/{job_id}", response_model=Dict[str, Any])
+async def get_image_job(job_id: str):
+    job = image_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません（期限切れの可能性があります）")
+    response = {"job_id": job_id, "status": job["status"]}
+    if job["status"] == "completed":
+        response["result"] = job["result"]
+    elif job["status"] == "error":
+        response["error"] = job["error"]
+    return response
+
+# OCRワーカーの受付状況を確認するエンドポイント
+@app.get("/image_jobs", response_model=Dict[str, Any])
+async def get_ocr_status():
+    return ocr_pool.stats()
 
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
@@ -304,6 +695,9 @@ async def root(request: Request):
             button:hover {
                 background-color: #45a049;
             }
+            .answer-text {
+                white-space: pre-wrap;
+            }
             #result {
                 margin-top: 20px;
                 border: 1px solid #ddd;
@@ -396,6 +790,7 @@ async def root(request: Request):
                 <p>ファイルを追加した後は、インデックスを再作成する必要があります。</p>
             </div>
             <button id="indexButton" onclick="createIndex()">インデックス作成</button>
+            <button id="cancelIndexButton" onclick="cancelIndex()" style="display: none;">キャンセル</button>
             <span id="indexStatus" class="status-indicator status-idle">未作成</span>
             <div id="indexDetails"></div>
         </div>
@@ -446,6 +841,10 @@ async def root(request: Request):
                 const indexStatus = document.getElementById('indexStatus');
                 const indexButton = document.getElementById('indexButton');
                 const indexDetails = document.getElementById('indexDetails');
+                const cancelIndexButton = document.getElementById('cancelIndexButton');
+                
+                // キャンセルボタンは実行中のみ表示
+                cancelIndexButton.style.display = data.is_running ? 'inline-block' : 'none';
                 
                 // ステータスクラスをリセット
                 indexStatus.className = 'status-indicator';
@@ -482,6 +881,20 @@ async def root(request: Request):
                             const elapsedTime = Math.floor(data.duration || 0);
                             indexDetails.textContent = `経過時間: ${formatTime(elapsedTime)}`;
                         }
+                        
+                        // 進捗を表示
+                        if (data.phase === 'processing' && data.files_to_process !== null) {
+                            let progressText = ` / 処理済み: ${data.files_processed}/${data.files_to_process}ファイル, ${data.chunks}チャンク`;
+                            if (data.chunks_per_second) {
+                                progressText += ` (${data.chunks_per_second.toFixed(1)}チャンク/秒)`;
+                            }
+                            if (data.eta_seconds !== null) {
+                                progressText += ` / 残り約${formatTime(data.eta_seconds)}`;
+                            }
+                            indexDetails.textContent += progressText;
+                        } else if (data.phase) {
+                            indexDetails.textContent += ` / ${data.phase}`;
+                        }
                         break;
                     case 'completed':
                         indexStatus.textContent = '作成完了';
@@ -494,6 +907,13 @@ async def root(request: Request):
                             indexDetails.textContent = `所要時間: ${formatTime(data.duration)}`;
                         }
                         break;
+                    case 'cancelled':
+                        indexStatus.textContent = 'キャンセル済み';
+                        indexStatus.classList.add('status-idle');
+                        indexButton.disabled = false;
+                        indexDetails.style.display = 'block';
+                        indexDetails.textContent = data.message;
+                        break;
                     case 'error':
                         indexStatus.textContent = 'エラー';
                         indexStatus.classList.add('status-error');
@@ -530,6 +950,7 @@ async def root(request: Request):
                     });
                     
                     const data = await response.json();
+                    checkIndexingStatus();
                     
                     // 状態確認を開始
                     if (!indexingStatusChecker) {
@@ -544,6 +965,53 @@ async def root(request: Request):
                 }
             }
             
+            // 実行中のインデックス作成をキャンセルする関数
+            async function cancelIndex() {
+                try {
+                    await fetch('/index/cancel', { method: 'POST' });
+                    checkIndexingStatus();
+                } catch (error) {
+                    console.error('キャンセルに失敗しました:', error);
+                }
+            }
+            
+            // ストリーミングで受け取ったイベントを表示に反映する関数
+            function handleStreamEvent(message, answerText, sourceList) {
+                let event = 'message';
+                let data = '';
+                message.split('\\n').forEach(line => {
+                    if (line.startsWith('event: ')) {
+                        event = line.slice(7);
+                    } else if (line.startsWith('data: ')) {
+                        data += line.slice(6);
+                    }
+                });
+                const payload = data ? JSON.parse(data) : null;
+                
+                switch (event) {
+                    case 'sources':
+                        if (payload.length > 0) {
+                            let sourcesHTML = `<h3>参照ソース:</h3>`;
+                            payload.forEach((source, index) => {
+                                sourcesHTML += `
+                                    <div class="source">
+                                        <div class="source-file">ファイル: ${source.location || source.file}${source.files && source.files.length > 1 ? '（同じ内容: ' + source.files.filter(f => f !== source.file).join(', ') + '）' : ''}</div>
+                                        <pre>${source.content}</pre>
+                                    </div>
+                                `;
+                            });
+                            sourceList.innerHTML = sourcesHTML;
+                        }
+                        break;
+                    case 'token':
+                        answerText.textContent += payload;
+                        break;
+                    case 'error':
+                        answerText.textContent = payload.detail;
+                        break;
+                }
+            }
+            
             // 質問を送信する関数
             async function askQuestion() {
                 const questionInput = document.getElementById('questionInput');
@@ -556,9 +1024,13 @@ async def root(request: Request):
                 }
                 
                 queryLoading.style.display = 'inline';
+                resultDiv.innerHTML = `<h3>回答:</h3><p id="answerText" class="answer-text"></p><div id="sourceList"></div>`;
+                const answerText = document.getElementById('answerText');
+                const sourceList = document.getElementById('sourceList');
                 
                 try {
-                    const response = await fetch('/query', {
+                    // 回答はServer-Sent Eventsで少しずつ届くので、届いた分から表示する
+                    const response = await fetch('/query/stream', {
                         method: 'POST',
                         headers: {
                             'Content-Type': 'application/json'
@@ -568,23 +1040,25 @@ async def root(request: Request):
                         })
                     });
                     
-                    const data = await response.json();
-                    
-                    let resultHTML = `<h3>回答:</h3><p>${data.answer ? data.answer.replace(/\\n/g, '<br>') : ''}</p>`;
+                    const reader = response.body.getReader();
+                    const decoder = new TextDecoder();
+                    let buffer = '';
                     
-                    if (data.sources && data.sources.length > 0) {
-                        resultHTML += `<h3>参照ソース:</h3>`;
-                        data.sources.forEach((source, index) => {
-                            resultHTML += `
-                                <div class="source">
-                                    <div class="source-file">ファイル: ${source.file}</div>
-                                    <pre>${source.content}</pre>
-                                </div>
-                            `;
-                        });
+                    while (true) {
+                        const { value, done } = await reader.read();
+                        if (done) {
+                            break;
+                        }
+                        buffer += decoder.decode(value, { stream: true });
+                        
+                        // イベントは空行で区切られている
+                        let boundary;
+                        while ((boundary = buffer.indexOf('\\n\\n')) !== -1) {
+                            const message = buffer.slice(0, boundary);
+                            buffer = buffer.slice(boundary + 2);
+                            handleStreamEvent(message, answerText, sourceList);
+                        }
                     }
-                    
-                    resultDiv.innerHTML = resultHTML;
                 } catch (error) {
                     resultDiv.innerHTML = `<p>エラーが発生しました: ${error.message}</p>`;
                 } finally {